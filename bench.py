@@ -0,0 +1,355 @@
+import os
+import sys
+import json
+import time
+import platform
+import argparse
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+import pygame as pg
+from pygame.math import Vector2 as Vec2
+from game import Game, SIM_DT, WIDTH, HEIGHT
+from isotiles import IsoTiles, spawn_building
+from projectiles import spawn_projectile
+from ecs import BUILDING, POSITION, PROJECTILE, World, drawables, interpolation
+from ecs import movement, offset_following, screen_culling
+from effects import CircularWaveAnimation
+
+# Benchmarks of the hot paths on synthetic worlds, e.g.
+#   python bench.py --sizes 1000 100000 --out before.json
+# Every world and effect placement comes from a fixed seed, so runs of different
+# commits time the same work
+SIZES = (1_000, 100_000, 1_000_000)
+SEED = 1234
+ZOOMS = (1.0, 0.5, 0.2)
+EFFECT_COUNTS = (0, 10, 100)
+OFFSET_QUERIES = 10_000
+PROJECTION_QUERIES = 10_000
+WORKER_COUNTS = sorted({1, 2, 4, os.cpu_count() or 1})
+COLLISION_LOADS = ((10, 100), (100, 1000), (1000, 1000))
+PROJECTILE_COUNTS = (100, 1000, 10000)
+ENTITY_COUNTS = (1000, 10000)
+
+
+def make_world(game: Game, size):
+    # Square world of about size tiles of random type and orientation
+    rng = np.random.default_rng(SEED)
+    side = int(round(size**0.5))
+    i, j = np.meshgrid(np.arange(side), np.arange(side), indexing="ij")
+    coords = np.stack((i.ravel(), j.ravel()), axis=1) - side // 2
+    types = rng.integers(0, game.max_types, len(coords))
+    flipped = rng.random(len(coords)) < 0.3
+    tiles = IsoTiles(game.sprite_cat)
+    for t in np.unique(types).tolist():
+        sel = types == t
+        tiles.add_tiles(coords[sel], t, flipped[sel])
+    tiles.set_origin(Vec2(WIDTH / 2, HEIGHT / 2))
+    return tiles
+
+
+def add_effects(tiles: IsoTiles, count, spread):
+    rng = np.random.default_rng(SEED)
+    for i, j in rng.integers(-spread, spread + 1, (count, 2)).tolist():
+        tiles.animations.add(
+            CircularWaveAnimation(amplitude=1.5, ahead=0.8, trail=2, epicenter=(i, j))
+        )
+    tiles.update()
+
+
+def measure(fn, repeat, setup=None):
+    # Durations of repeat calls of fn in milliseconds, setup runs untimed before
+    # each call
+    times = []
+    for _ in range(repeat):
+        if setup:
+            setup()
+        t0 = time.perf_counter()
+        fn()
+        times.append((time.perf_counter() - t0) * 1000)
+    return times
+
+
+def result(name, params, times):
+    return {
+        "name": name,
+        "params": params,
+        "runs": len(times),
+        "min_ms": min(times),
+        "median_ms": float(np.median(times)),
+        "mean_ms": float(np.mean(times)),
+    }
+
+
+def bench_draw(game: Game, tiles: IsoTiles, size, repeat):
+    surf = pg.Surface((WIDTH, HEIGHT))
+    results = []
+    for zoom in ZOOMS:
+        game.sprite_cat.scale_catalogue(zoom)
+        tiles.drop_baked()
+        # The first frame bakes the static chunks, later ones reuse them
+        cold = measure(lambda: tiles.draw(surf), 1)
+        warm = measure(lambda: tiles.draw(surf), repeat)
+        params = {"tiles": size, "zoom": zoom}
+        results.append(result("draw_cold", params, cold))
+        results.append(result("draw", params, warm))
+    game.sprite_cat.scale_catalogue(1.0)
+    return results
+
+
+def bench_offsets(tiles: IsoTiles, size, repeat):
+    rng = np.random.default_rng(SEED)
+    side = int(round(size**0.5))
+    picks = rng.integers(-side // 2, side // 2, (OFFSET_QUERIES, 2))
+    queries = [tuple(t) for t in picks.tolist()]
+    results = []
+    for count in EFFECT_COUNTS:
+        tiles.animations.empty()
+        add_effects(tiles, count, side // 2)
+
+        def query():
+            for t in queries:
+                tiles.get_tile_offset(t)
+
+        # Each frame starts with an empty offset field
+        times = measure(query, repeat, setup=tiles.update)
+        params = {"tiles": size, "effects": count, "queries": OFFSET_QUERIES}
+        results.append(result("get_tile_offset", params, times))
+    tiles.animations.empty()
+    tiles.update()
+    return results
+
+
+def bench_offset_field(game: Game, tiles: IsoTiles, size, repeat):
+    # Offsets of the whole world at once under many effects, on 1 to all cores
+    side = int(round(size**0.5))
+    chunks = sorted(tiles.chunks.values(), key=lambda c: c.key)
+    tiles.animations.empty()
+    add_effects(tiles, EFFECT_COUNTS[-1], side // 2)
+    results = []
+    for workers in WORKER_COUNTS:
+        with ThreadPoolExecutor(workers) as pool:
+            tiles.use_pool(pool, workers)
+            times = measure(lambda: tiles.offset_field(chunks), repeat)
+        params = {"tiles": size, "effects": EFFECT_COUNTS[-1], "workers": workers}
+        results.append(result("offset_field", params, times))
+    tiles.use_pool(None)
+    tiles.animations.empty()
+    tiles.update()
+    return results
+
+
+def bench_projection(tiles: IsoTiles, repeat):
+    # Screen to tile and back, one point at a time and as one array
+    rng = np.random.default_rng(SEED)
+    points = rng.uniform(0, (WIDTH, HEIGHT), (PROJECTION_QUERIES, 2))
+    vecs = [Vec2(p) for p in points.tolist()]
+
+    def scalar():
+        for v in vecs:
+            tiles.iso_to_screen(tiles.screen_to_iso(v))
+
+    def array():
+        tiles.iso_to_screen_array(tiles.screen_to_iso_array(points))
+
+    params = {"queries": PROJECTION_QUERIES}
+    return [
+        result("projection", params, measure(scalar, repeat)),
+        result("projection_array", params, measure(array, repeat)),
+    ]
+
+
+def bench_serialization(game: Game, tiles: IsoTiles, size, repeat, tmpdir):
+    jstr = tiles.to_json()
+    filename = os.path.join(tmpdir, f"bench{size}.isow")
+    params = {"tiles": size}
+    return [
+        result("to_json", params, measure(tiles.to_json, repeat)),
+        result(
+            "from_json",
+            params,
+            measure(lambda: IsoTiles.from_json(game.sprite_cat, jstr), repeat),
+        ),
+        result("to_binary", params, measure(lambda: tiles.to_binary(filename), repeat)),
+        result(
+            "from_binary",
+            params,
+            measure(lambda: IsoTiles.from_binary(game.sprite_cat, filename), repeat),
+        ),
+    ]
+
+
+def bench_zoom(game: Game, repeat):
+    steps = [round(0.1 * n, 1) for n in range(1, 21)]
+
+    def zoom_through():
+        for z in steps:
+            game.sprite_cat.scale_catalogue(z)
+            game.building_cat.scale_catalogue(z)
+            # Scaled images are made when first drawn
+            for idx in range(len(game.sprite_cat.sprites)):
+                game.sprite_cat.get(idx)
+            game.sprite_cat.atlas()
+
+    cold = measure(zoom_through, 1)
+    warm = measure(zoom_through, repeat)
+    game.sprite_cat.scale_catalogue(1.0)
+    game.building_cat.scale_catalogue(1.0)
+    params = {"steps": len(steps)}
+    return [result("zoom_cold", params, cold), result("zoom", params, warm)]
+
+
+def clear_world(game: Game):
+    # Everything but the player
+    world: World = game.world
+    world.despawn(world.rows(POSITION, BUILDING))
+    world.despawn(world.rows(POSITION, PROJECTILE))
+
+
+def bench_collisions(game: Game, repeat):
+    rng = np.random.default_rng(SEED)
+    results = []
+    for buildings, projectiles in COLLISION_LOADS:
+        spots = rng.integers(-50, 50, (buildings + projectiles, 2)).tolist()
+
+        def populate():
+            # Buildings are hit and projectiles used up, start from scratch each run
+            clear_world(game)
+            for i, j in spots[:buildings]:
+                spawn_building(game.world, (i, j))
+            for i, j in spots[buildings:]:
+                spawn_projectile(game.world, (1, 0), (i + 0.5, j - 0.5))
+
+        times = measure(game.check_collisions, repeat, setup=populate)
+        params = {"buildings": buildings, "projectiles": projectiles}
+        results.append(result("check_collisions", params, times))
+    clear_world(game)
+    return results
+
+
+def bench_projectiles(game: Game, repeat):
+    # Moving and drawing a screen full of projectiles, without the tiles below
+    rng = np.random.default_rng(SEED)
+    surf = pg.Surface((WIDTH, HEIGHT))
+    game.tiles.set_origin(Vec2(WIDTH / 2, HEIGHT / 2))
+    world = game.world
+    renderers = {PROJECTILE: game.renderers[PROJECTILE]}
+    results = []
+    for count in PROJECTILE_COUNTS:
+        spots = rng.uniform(-1.5, 1.5, (count, 2)).tolist()
+        dirs = rng.choice([(1, 0), (0, 1), (-1, 0), (0, -1)], count).tolist()
+
+        def populate():
+            clear_world(game)
+            for d, at in zip(dirs, spots):
+                spawn_projectile(world, d, at)
+
+        def update():
+            movement(world, SIM_DT)
+            screen_culling(world, game.tiles, (WIDTH, HEIGHT))
+
+        def draw():
+            interpolation(world, 0.5)
+            for actor in drawables(world, renderers, surf.get_rect()):
+                actor.draw(surf)
+
+        params = {"projectiles": count}
+        times = measure(update, repeat, setup=populate)
+        results.append(result("projectiles_update", params, times))
+        results.append(result("projectiles_draw", params, measure(draw, repeat)))
+    clear_world(game)
+    return results
+
+
+def bench_entities(game: Game, repeat):
+    # Advancing many effects by one step, and a step of the entity systems with
+    # as many buildings and projectiles
+    results = []
+    for count in ENTITY_COUNTS:
+        game.tiles.animations.empty()
+        for n in range(count):
+            game.tiles.animations.add(
+                CircularWaveAnimation(amplitude=1e6, epicenter=(n, 0))
+            )
+        times = measure(lambda: game.tiles.animations.update(SIM_DT), repeat)
+        results.append(result("effects_step", {"effects": count}, times))
+        game.tiles.animations.empty()
+        rng = np.random.default_rng(SEED)
+        spots = rng.integers(-50, 50, (2 * count, 2)).tolist()
+
+        def populate():
+            clear_world(game)
+            for i, j in spots[:count]:
+                spawn_building(game.world, (i, j))
+            for i, j in spots[count:]:
+                spawn_projectile(game.world, (1, 0), (i + 0.5, j - 0.5))
+
+        def step():
+            movement(game.world, SIM_DT)
+            game.check_collisions()
+            interpolation(game.world, 0.5)
+            offset_following(game.world, game.tiles)
+            drawables(game.world, game.renderers, game.window.get_rect())
+
+        times = measure(step, repeat, setup=populate)
+        results.append(result("world_step", {"entities": 2 * count}, times))
+        clear_world(game)
+        game.tiles.animations.empty()
+    return results
+
+
+def metadata():
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            capture_output=True,
+            text=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+        ).stdout.strip()
+    except OSError:
+        commit = ""
+    return {
+        "commit": commit,
+        "python": platform.python_version(),
+        "pygame": pg.version.ver,
+        "numpy": np.__version__,
+        "platform": platform.platform(),
+        "video_driver": pg.display.get_driver(),
+        "converted_sprites": pg.display.get_surface() is not None,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the game's hot paths")
+    parser.add_argument("--sizes", type=int, nargs="+", default=SIZES)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--out", help="write the results to this JSON file")
+    parser.add_argument("--tmpdir", default=".", help="where world files are written")
+    args = parser.parse_args()
+    # A display, even the dummy one, lets the sprites be converted to its format
+    # when loaded as in a windowed game, see load_image
+    pg.init()
+    pg.display.set_mode((WIDTH, HEIGHT))
+    game = Game(headless=True)
+    results = []
+    for size in args.sizes:
+        print(f"{size} tiles", file=sys.stderr)
+        tiles = make_world(game, size)
+        results += bench_draw(game, tiles, size, args.repeat)
+        results += bench_offsets(tiles, size, args.repeat)
+        results += bench_offset_field(game, tiles, size, args.repeat)
+        results += bench_projection(tiles, args.repeat)
+        results += bench_serialization(game, tiles, size, args.repeat, args.tmpdir)
+        os.remove(os.path.join(args.tmpdir, f"bench{size}.isow"))
+    results += bench_zoom(game, args.repeat)
+    results += bench_collisions(game, args.repeat)
+    results += bench_projectiles(game, args.repeat)
+    results += bench_entities(game, args.repeat)
+    report = json.dumps({"meta": metadata(), "results": results}, indent=2)
+    if args.out:
+        with open(args.out, "w") as ofile:
+            ofile.write(report)
+    else:
+        print(report)
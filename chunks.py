@@ -0,0 +1,184 @@
+import numpy as np
+
+CHUNK_SIZE = 8
+# Tile type stored for cells that hold no tile
+EMPTY = -1
+# Bits of TileChunk.flags
+FLIPPED = 1
+
+
+def chunk_key(tile):
+    return (tile[0] // CHUNK_SIZE, tile[1] // CHUNK_SIZE)
+
+
+def fill_chunks(chunks: dict, coords, types, flipped=False):
+    # Write an (N, 2) array of tiles into the chunks, creating missing ones.
+    # Returns the chunks that have been touched
+    coords = np.asarray(coords, dtype=np.int64).reshape(-1, 2)
+    if not len(coords):
+        return []
+    types = np.broadcast_to(np.asarray(types, dtype=np.int16), len(coords))
+    flags = np.where(np.broadcast_to(flipped, len(coords)), FLIPPED, 0)
+    keys = coords // CHUNK_SIZE
+    cells = coords - keys * CHUNK_SIZE
+    # Stable sort, so the last write to a cell wins like with single writes
+    perm = np.lexsort((keys[:, 1], keys[:, 0]))
+    keys, cells, types, flags = keys[perm], cells[perm], types[perm], flags[perm]
+    starts = np.flatnonzero(np.any(keys[1:] != keys[:-1], axis=1)) + 1
+    touched = []
+    for a, b in zip(np.r_[0, starts], np.r_[starts, len(keys)]):
+        key = (int(keys[a, 0]), int(keys[a, 1]))
+        if key not in chunks:
+            chunks[key] = TileChunk(key)
+        chunk = chunks[key]
+        chunk.types[cells[a:b, 0], cells[a:b, 1]] = types[a:b]
+        chunk.flags[cells[a:b, 0], cells[a:b, 1]] = flags[a:b]
+        chunk.recount()
+        touched.append(chunk)
+    return touched
+
+
+def chunk_tiles(chunks):
+    # All tiles of the chunks as (N, 2) coordinates, types and flipped flags
+    chunks = sorted(chunks, key=lambda c: c.key)
+    if not chunks:
+        return np.zeros((0, 2), np.int64), np.zeros(0, np.int16), np.zeros(0, bool)
+    coords = np.concatenate([c.coord_array() for c in chunks]).astype(np.int64)
+    types = np.concatenate([c.type_array() for c in chunks])
+    flipped = np.concatenate([c.flipped_array() for c in chunks])
+    return coords, types, flipped
+
+
+class TileChunk:
+    # Large maps hold a lot of chunks, keep them small. A chunk costs about 780
+    # bytes however few tiles it holds, so filled maps take about 11 bytes per
+    # tile while scattered ones with a tile or two per chunk take up to 900
+    __slots__ = (
+        "key",
+        "i0",
+        "j0",
+        "types",
+        "flags",
+        "offsets",
+        "count",
+        "order",
+        "surface",
+        "surface_pos",
+        "static",
+        "lift",
+    )
+
+    def __init__(self, key):
+        self.key = key
+        self.i0 = key[0] * CHUNK_SIZE
+        self.j0 = key[1] * CHUNK_SIZE
+        # Dense per cell storage, indexed by the position inside the chunk
+        self.types = np.full((CHUNK_SIZE, CHUNK_SIZE), EMPTY, dtype=np.int16)
+        self.flags = np.zeros((CHUNK_SIZE, CHUNK_SIZE), dtype=np.uint8)
+        # Offsets are rare, only allocated once one is set. lift is the largest
+        # magnitude any of them has had
+        self.offsets = None
+        self.lift = 0.0
+        self.count = 0
+        # Flat cell indices of the tiles in depth order, kept up to date by set and
+        # clear, and rebuilt lazily after writing to the arrays
+        self.order = None
+        # Pre-rendered image of the whole chunk and its position relative to the origin
+        self.surface = None
+        self.surface_pos = (0, 0)
+        # Whether the chunk only holds non animated sprites, None if not known yet
+        self.static = None
+
+    def __len__(self):
+        return self.count
+
+    def local(self, tile) -> None | tuple[int, int]:
+        # Cell of the tile inside this chunk, None if it is not on the grid
+        li, lj = tile[0] - self.i0, tile[1] - self.j0
+        if li != int(li) or lj != int(lj):
+            return None
+        return int(li), int(lj)
+
+    def get(self, tile) -> None | int:
+        if (cell := self.local(tile)) is None or self.types[cell] == EMPTY:
+            return None
+        return int(self.types[cell])
+
+    def set(self, tile, ttype, flipped):
+        cell = self.local(tile)
+        if self.types[cell] == EMPTY:
+            self.count += 1
+            if self.order is not None:
+                n = cell[0] * CHUNK_SIZE + cell[1]
+                self.order = np.insert(self.order, np.searchsorted(self.order, n), n)
+        self.types[cell] = ttype
+        self.flags[cell] = FLIPPED if flipped else 0
+
+    def clear(self, tile):
+        cell = self.local(tile)
+        if self.types[cell] != EMPTY:
+            self.count -= 1
+            if self.order is not None:
+                n = cell[0] * CHUNK_SIZE + cell[1]
+                self.order = np.delete(self.order, np.searchsorted(self.order, n))
+        self.types[cell] = EMPTY
+        self.flags[cell] = 0
+        if self.offsets is not None:
+            self.offsets[cell] = 0.0
+
+    def set_offset(self, tile, offset):
+        if self.offsets is None:
+            self.offsets = np.zeros((CHUNK_SIZE, CHUNK_SIZE), dtype=np.float32)
+        self.offsets[self.local(tile)] = offset
+        self.lift = max(self.lift, abs(float(offset)))
+
+    def get_offset(self, tile) -> float:
+        # Stored offset of the tile, 0 where none has been set
+        if self.offsets is None or (cell := self.local(tile)) is None:
+            return 0.0
+        return float(self.offsets[cell])
+
+    def recount(self):
+        # Resynchronize after writing to the arrays directly
+        self.count = int(np.count_nonzero(self.types != EMPTY))
+        self.order = None
+        self.invalidate()
+
+    def invalidate(self):
+        self.surface = None
+        self.static = None
+
+    def cell_order(self) -> np.ndarray:
+        # Row major order over (i, j) is also the back to front drawing order
+        if self.order is None:
+            self.order = np.flatnonzero(self.types.ravel() != EMPTY)
+        return self.order
+
+    def slot_of(self, tile) -> None | int:
+        # Position of the tile in the depth order
+        if (cell := self.local(tile)) is None or self.types[cell] == EMPTY:
+            return None
+        n = cell[0] * CHUNK_SIZE + cell[1]
+        return int(np.searchsorted(self.cell_order(), n))
+
+    def depth_slot(self, tile) -> int:
+        # Number of tiles of the chunk drawn before something standing on tile
+        li, lj = tile[0] - self.i0, tile[1] - self.j0
+        return int(np.searchsorted(self.cell_order(), li * CHUNK_SIZE + lj, "right"))
+
+    def coord_array(self) -> np.ndarray:
+        order = self.cell_order()
+        return np.stack(
+            (self.i0 + order // CHUNK_SIZE, self.j0 + order % CHUNK_SIZE), axis=1
+        ).astype(float)
+
+    def type_array(self) -> np.ndarray:
+        return self.types.ravel()[self.cell_order()]
+
+    def flipped_array(self) -> np.ndarray:
+        return (self.flags.ravel()[self.cell_order()] & FLIPPED) != 0
+
+    def offset_array(self) -> np.ndarray:
+        if self.offsets is None:
+            return np.zeros(len(self.cell_order()))
+        return self.offsets.ravel()[self.cell_order()].astype(float)
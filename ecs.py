@@ -0,0 +1,223 @@
+import numpy as np
+
+# Components, bits of World.mask. A row with mask 0 is free. Each component
+# owns some of the arrays of the World:
+#   POSITION         pos, prev_pos, draw_pos in tiles and anchor, the tile an
+#                    entity stands on is floor(pos) + anchor
+#   VELOCITY         vel in tiles per second
+#   HEALTH           hp and max_hp, can be hit and dies once hp reaches 0
+#   RENDERABLE       kind, selects the renderer drawing the entity
+#   COLLIDER         damage dealt to the first entity with HEALTH on its tile,
+#                    the collider is used up by that
+#   OFFSET_FOLLOWER  lift, the offset of the tile it stands on this frame
+#   SCREEN_BOUND     despawned once it leaves the screen
+POSITION = 1
+VELOCITY = 2
+HEALTH = 4
+RENDERABLE = 8
+COLLIDER = 16
+OFFSET_FOLLOWER = 32
+SCREEN_BOUND = 64
+
+# Values of World.kind
+PLAYER = 1
+BUILDING = 2
+PROJECTILE = 3
+
+# Rows allocated up front, the world doubles whenever all of them are in use
+WORLD_SIZE = 256
+
+# Per row arrays, by name, with their trailing shape and dtype
+COLUMNS = {
+    "mask": ((), np.uint8),
+    "pos": ((2,), float),
+    "prev_pos": ((2,), float),
+    "draw_pos": ((2,), float),
+    "anchor": ((2,), np.int64),
+    "vel": ((2,), float),
+    "hp": ((), float),
+    "max_hp": ((), float),
+    "kind": ((), np.int8),
+    "damage": ((), float),
+    "lift": ((), float),
+}
+
+
+def tile_keys(tiles: np.ndarray) -> np.ndarray:
+    # One int64 per (N, 2) tile, for matching tiles with np.isin
+    tiles = tiles.astype(np.int64)
+    return (tiles[:, 0] << 32) | (tiles[:, 1] & 0xFFFFFFFF)
+
+
+class World:
+    # All entities as rows of dense component arrays. Spawning takes a row off
+    # the free list and despawning hands it back, systems work on the rows
+    # having the components they need all at once
+    def __init__(self, capacity=WORLD_SIZE):
+        for name, (shape, dtype) in COLUMNS.items():
+            setattr(self, name, np.zeros((capacity, *shape), dtype))
+        # Lowest free row on top
+        self.free = list(range(capacity - 1, -1, -1))
+
+    def __len__(self):
+        return len(self.mask) - len(self.free)
+
+    def grow(self):
+        capacity = len(self.mask)
+        for name in COLUMNS:
+            rows = getattr(self, name)
+            setattr(self, name, np.concatenate((rows, np.zeros_like(rows))))
+        self.free.extend(range(2 * capacity - 1, capacity - 1, -1))
+
+    def spawn(self, components, **values) -> int:
+        # values fill the arrays of the new row by name, the rest are zeroed
+        if not self.free:
+            self.grow()
+        row = self.free.pop()
+        for name in COLUMNS:
+            getattr(self, name)[row] = 0
+        for name, value in values.items():
+            getattr(self, name)[row] = value
+        if "pos" in values:
+            self.prev_pos[row] = self.draw_pos[row] = self.pos[row]
+        self.mask[row] = components
+        return row
+
+    def despawn(self, rows):
+        # rows is a row or an array of them, free ones are skipped
+        rows = np.atleast_1d(np.asarray(rows, np.int64))
+        rows = np.unique(rows[self.mask[rows] != 0])
+        self.mask[rows] = 0
+        self.free.extend(rows.tolist())
+
+    def rows(self, components, kind=None) -> np.ndarray:
+        # Rows having all of the components, of one kind if given
+        has = (self.mask & components) == components
+        if kind is not None:
+            has &= self.kind == kind
+        return np.flatnonzero(has)
+
+    def tiles_of(self, rows) -> np.ndarray:
+        return np.floor(self.pos[rows]).astype(np.int64) + self.anchor[rows]
+
+
+def movement(world: World, dt):
+    rows = world.rows(POSITION)
+    world.prev_pos[rows] = world.pos[rows]
+    moving = world.rows(POSITION | VELOCITY)
+    world.pos[moving] += dt * world.vel[moving]
+
+
+def interpolation(world: World, alpha):
+    # Where everything is drawn, alpha of the way from the previous step
+    rows = world.rows(POSITION)
+    prev = world.prev_pos[rows]
+    world.draw_pos[rows] = prev + (world.pos[rows] - prev) * alpha
+
+
+def screen_culling(world: World, tiles, bounds):
+    # Despawn what left the (width, height) of the screen
+    rows = world.rows(POSITION | SCREEN_BOUND)
+    at = tiles.iso_to_screen_array(world.pos[rows])
+    width, height = bounds
+    x, y = at[:, 0], at[:, 1]
+    world.despawn(rows[(x > width) | (x < 0) | (y > height) | (y < 0)])
+
+
+def collisions(world: World):
+    # Every collider, in row order, damages the first entity with health left on
+    # its tile and is used up by that
+    colliders = world.rows(POSITION | COLLIDER)
+    targets = world.rows(POSITION | HEALTH)
+    targets = targets[world.hp[targets] > 0]
+    if not len(colliders) or not len(targets):
+        return
+    c_keys = tile_keys(world.tiles_of(colliders))
+    t_keys = tile_keys(world.tiles_of(targets))
+    # Only the few colliders and targets sharing a tile are gone through one by one
+    hitting = np.isin(c_keys, t_keys, kind="sort")
+    hit = np.isin(t_keys, c_keys[hitting], kind="sort")
+    on_tile: dict[int, list[int]] = {}
+    for row, key in zip(targets[hit].tolist(), t_keys[hit].tolist()):
+        on_tile.setdefault(key, []).append(row)
+    hp = dict(zip(targets[hit].tolist(), world.hp[targets[hit]].tolist()))
+    damage = world.damage[colliders[hitting]].tolist()
+    spent = []
+    hits = zip(colliders[hitting].tolist(), c_keys[hitting].tolist(), damage)
+    for row, key, dmg in hits:
+        for target in on_tile[key]:
+            if hp[target] > 0:
+                hp[target] -= dmg
+                spent.append(row)
+                break
+    world.hp[list(hp)] = list(hp.values())
+    world.despawn(spent)
+
+
+def deaths(world: World) -> list[tuple[float, float]]:
+    # Despawn whatever ran out of health, returns where they were
+    rows = world.rows(POSITION | HEALTH)
+    dead = rows[world.hp[rows] <= 0]
+    at = [tuple(p) for p in world.pos[dead].tolist()]
+    world.despawn(dead)
+    return at
+
+
+def offset_following(world: World, tiles):
+    # Lift everything following the offsets with the tile below it
+    rows = world.rows(POSITION | OFFSET_FOLLOWER)
+    world.lift[rows] = tiles.get_tile_offsets(world.tiles_of(rows))
+
+
+class Drawable:
+    # An actor for IsoTiles.draw, drawn by fn(surf, *args) after its tile
+    __slots__ = ("tile", "fn", "args")
+
+    def __init__(self, tile, fn, *args):
+        self.tile = tile
+        self.fn = fn
+        self.args = args
+
+    def draw(self, surf):
+        self.fn(surf, *self.args)
+
+
+def in_view(world: World, renderers: dict, view):
+    # (renderer, rows) for every kind with rows drawn into the view. Renderers
+    # tell the box (x0, y0, x1, y1) around the screen position of draw_pos that
+    # all they draw for an entity stays in
+    rows = world.rows(POSITION | RENDERABLE)
+    kinds = world.kind[rows]
+    for kind, renderer in renderers.items():
+        of_kind = rows[kinds == kind]
+        if not len(of_kind):
+            continue
+        at = renderer.tiles.iso_to_screen_array(world.draw_pos[of_kind])
+        x0, y0, x1, y1 = renderer.extent()
+        x, y = at[:, 0], at[:, 1]
+        seen = (
+            (x + x1 >= view.left)
+            & (x + x0 <= view.right)
+            & (y + y1 >= view.top)
+            & (y + y0 <= view.bottom)
+        )
+        if len(of_kind := of_kind[seen]):
+            yield renderer, of_kind
+
+
+def drawables(world: World, renderers: dict, view) -> list[Drawable]:
+    # Actors of everything renderable in the view, renderers are by kind and each
+    # makes the actors for all rows of its kind at once
+    actors = []
+    for renderer, rows in in_view(world, renderers, view):
+        actors += renderer.actors(world, rows)
+    return actors
+
+
+def screen_states(world: World, renderers: dict, view) -> dict:
+    # Screen rect and look of everything renderable in the view, see
+    # Game.find_dirty_rects
+    states = {}
+    for renderer, rows in in_view(world, renderers, view):
+        states.update(renderer.screen_states(world, rows))
+    return states
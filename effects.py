@@ -1,9 +1,24 @@
-import pygame as pg
+import numpy as np
 from math import pi, acos
 from pygame.math import Vector2 as Vec2
+from entities import Entity
 
+# State shared by all the waves travelling out from an epicenter
+WAVE_SLOTS = (
+    "speed",
+    "center",
+    "time",
+    "max_duration",
+    "trail",
+    "ahead",
+    "dampening",
+    "amplitude",
+)
+
+
+class TileAnimation(Entity):
+    __slots__ = ()
 
-class TileAnimation(pg.sprite.Sprite):
     def __init__(self):
         super().__init__()
 
@@ -13,6 +28,47 @@ class TileAnimation(pg.sprite.Sprite):
     def get_offset(self, tile) -> float:
         return 0
 
+    def get_offsets(self, coords: np.ndarray) -> np.ndarray:
+        # Batch version of get_offset for an (N, 2) array of tile coordinates
+        return np.fromiter(
+            (self.get_offset((i, j)) for i, j in coords.tolist()), float, len(coords)
+        )
+
+    def get_radius(self) -> None | float:
+        # Distance from the epicenter beyond which get_offset is zero, None if unbounded
+        return None
+
+    def get_amplitude(self) -> float:
+        # Largest magnitude get_offset takes anywhere
+        return 0.0
+
+    def get_inner_radius(self) -> float:
+        # Distance from the epicenter below which get_offset is zero again
+        return 0.0
+
+    def get_bounds(self):
+        # Tile space (i0, j0, i1, j1) box outside of which get_offset is zero
+        r = self.get_radius()
+        if r is None:
+            return None
+        return (
+            self.center.x - r, self.center.y - r, self.center.x + r, self.center.y + r
+        )
+
+    def reaches(self, i0, j0, i1, j1) -> bool:
+        # Whether any tile in the inclusive box (i0, j0, i1, j1) can get an offset
+        r = self.get_radius()
+        if r is None:
+            return True
+        cx, cy = self.center
+        near_x = max(i0 - cx, 0, cx - i1)
+        near_y = max(j0 - cy, 0, cy - j1)
+        if near_x**2 + near_y**2 >= r**2:
+            return False
+        far_x = max(abs(cx - i0), abs(cx - i1))
+        far_y = max(abs(cy - j0), abs(cy - j1))
+        return far_x**2 + far_y**2 > self.get_inner_radius() ** 2
+
 
 def smoothstep(le, re, x):
     clamp = lambda x: max(0, min(1, x))
@@ -27,7 +83,25 @@ def two_smoothstep(le, re, x):
         return 1 - smoothstep(0, re, x)
 
 
+def smoothstep_array(le, re, x: np.ndarray) -> np.ndarray:
+    x = np.clip((x - le) / (re - le), 0, 1)
+    return x**2 * (3 - 2 * x)
+
+
+def two_smoothstep_array(le, re, x: np.ndarray) -> np.ndarray:
+    return np.where(x < 0, smoothstep_array(le, 0, x), 1 - smoothstep_array(0, re, x))
+
+
+def center_distance(coords: np.ndarray, center: Vec2):
+    # Per tile vector from the center and its length, like (Vec2(t) - center)
+    dx = coords[:, 0] - center.x
+    dy = coords[:, 1] - center.y
+    return dx, dy, np.sqrt(dx * dx + dy * dy)
+
+
 class DirectedShockwave(TileAnimation):
+    __slots__ = (*WAVE_SLOTS, "width", "dir")
+
     def __init__(
         self,
         epicenter=(0, 0),
@@ -75,11 +149,38 @@ class DirectedShockwave(TileAnimation):
             )
         )
 
+    def get_offsets(self, coords):
+        dx, dy, d = center_distance(coords, self.center)
+        la = self.dir.length()
+        if la <= 1e-13:
+            angle = np.zeros_like(d)
+        else:
+            # Same as diff_angle, tiles at the epicenter count as perfectly aligned
+            valid = d > 1e-13
+            cos = (self.dir.x * dx + self.dir.y * dy) / (la * np.where(valid, d, 1.0))
+            angle = np.where(valid, np.arccos(np.clip(cos, -1.0, 1.0)), 0.0)
+        return (
+            -self.amplitude
+            * two_smoothstep_array(-self.trail, self.ahead, d - self.time)
+            * (1 - smoothstep_array(0, self.width, angle))
+        )
+
+    def get_radius(self):
+        return max(0.0, self.time + self.ahead)
+
+    def get_inner_radius(self):
+        return max(0.0, self.time - self.trail)
+
+    def get_amplitude(self):
+        return abs(self.amplitude)
+
     def __str__(self):
         return "DirectedShockwave"
 
 
 class CrossWaveAnimation(TileAnimation):
+    __slots__ = WAVE_SLOTS
+
     def __init__(
         self,
         epicenter=(0, 0),
@@ -120,11 +221,30 @@ class CrossWaveAnimation(TileAnimation):
         else:
             return 0.0
 
+    def get_offsets(self, coords):
+        dx, dy, d = center_distance(coords, self.center)
+        on_cross = (dx == 0) | (dy == 0)
+        val = -self.amplitude * two_smoothstep_array(
+            -self.trail, self.ahead, d - self.time
+        )
+        return np.where(on_cross, val, 0.0)
+
+    def get_radius(self):
+        return max(0.0, self.time + self.ahead)
+
+    def get_inner_radius(self):
+        return max(0.0, self.time - self.trail)
+
+    def get_amplitude(self):
+        return abs(self.amplitude)
+
     def __str__(self):
         return "CrossWave"
 
 
 class CircularWaveAnimation(TileAnimation):
+    __slots__ = WAVE_SLOTS
+
     def __init__(
         self,
         epicenter=(0, 0),
@@ -158,5 +278,20 @@ class CircularWaveAnimation(TileAnimation):
         val = -self.amplitude * two_smoothstep(-self.trail, self.ahead, d - self.time)
         return val
 
+    def get_offsets(self, coords):
+        dx, dy, d = center_distance(coords, self.center)
+        return -self.amplitude * two_smoothstep_array(
+            -self.trail, self.ahead, d - self.time
+        )
+
+    def get_radius(self):
+        return max(0.0, self.time + self.ahead)
+
+    def get_inner_radius(self):
+        return max(0.0, self.time - self.trail)
+
+    def get_amplitude(self):
+        return abs(self.amplitude)
+
     def __str__(self):
         return "CircularWave"
@@ -0,0 +1,63 @@
+class Entity:
+    # Something living in at most one EntityGroup, with the parts of the
+    # pg.sprite.Sprite interface the game uses. Subclasses list their
+    # attributes in __slots__, so no entity carries an instance dict
+    __slots__ = ("group",)
+
+    def __init__(self):
+        self.group: None | EntityGroup = None
+
+    def update(self, *args):
+        pass
+
+    def alive(self):
+        return self.group is not None
+
+    def kill(self):
+        if self.group is not None:
+            self.group.remove(self)
+
+
+class EntityGroup:
+    # Insertion ordered set of entities standing in for pg.sprite.Group. Adding
+    # an entity moves it out of the group it was in before
+    __slots__ = ("members",)
+
+    def __init__(self, *entities):
+        self.members: dict[Entity, None] = {}
+        self.add(*entities)
+
+    def add(self, *entities):
+        for e in entities:
+            if e.group is not self:
+                if e.group is not None:
+                    e.group.remove(e)
+                e.group = self
+                self.members[e] = None
+
+    def remove(self, *entities):
+        for e in entities:
+            if self.members.pop(e, 0) is None:
+                e.group = None
+
+    def empty(self):
+        for e in self.members:
+            e.group = None
+        self.members = {}
+
+    def update(self, *args):
+        # Entities may leave the group while it is being updated
+        for e in list(self.members):
+            e.update(*args)
+
+    def __iter__(self):
+        return iter(list(self.members))
+
+    def __len__(self):
+        return len(self.members)
+
+    def __bool__(self):
+        return bool(self.members)
+
+    def __contains__(self, e):
+        return e in self.members
@@ -1,15 +1,69 @@
 import pygame as pg
 import os
+import sys
+import json
+import time
+import argparse
+import hashlib
+import numpy as np
 from pygame.math import Vector2 as Vec2
 from enum import Enum
+from concurrent.futures import ThreadPoolExecutor
 from effects import DirectedShockwave, CrossWaveAnimation, CircularWaveAnimation
 from sprites import SpriteCatalogue, Sprite, AnimatedSprite, Cycle
-from isotiles import IsoTiles, Building
+from isotiles import IsoTiles, BuildingRenderer, spawn_building
+from projectiles import ProjectileRenderer, spawn_projectile
+from ecs import BUILDING, HEALTH, PLAYER, POSITION, PROJECTILE, RENDERABLE
+from ecs import Drawable, World, collisions, deaths, drawables, interpolation
+from ecs import movement, offset_following, screen_culling, screen_states
+from streaming import ChunkStreamer
+from chunks import chunk_tiles
+from worldio import dumps_tiles
+from journal import EditJournal, TileEdits, journal_files
+from inputs import LiveInput, ScriptedInput
+from profiler import FrameProfiler
+from textcache import TextCache
 
 WIDTH = 800
 HEIGHT = 600
-TAU = 1 / 60
+# The simulation advances in fixed steps of SIM_DT seconds, however fast frames
+# are rendered. A frame runs at most MAX_STEPS of them, and with frame dropping
+# on, up to MAX_SKIP frames in a row are not rendered to catch up
+SIM_DT = 1 / 60
+MAX_STEPS = 8
+MAX_SKIP = 4
+# Speeds in tiles and pixels per second
+PLAYER_SPEED = 6.0
+CAMERA_SPEED = 180
 FONT_SIZE = 16
+# Parts of a frame timed by the profiler overlay, toggled with PROFILER_KEY
+PROFILE_PHASES = (
+    "events",
+    "streaming",
+    "autosave",
+    "sprites",
+    "movement",
+    "player",
+    "collisions",
+    "effects",
+    "tiles",
+    "ui",
+    "display",
+)
+PROFILER_KEY = pg.K_F3
+BACKGROUND = (0, 80, 180)
+# In dirty rect mode a frame only redraws the parts of the window that changed,
+# unless there are more than MAX_DIRTY_RECTS of them or they cover more than
+# FULL_REDRAW_AREA of the window. After IDLE_FRAMES frames without any change the
+# frame rate drops to IDLE_FPS
+MAX_DIRTY_RECTS = 32
+FULL_REDRAW_AREA = 0.5
+IDLE_FRAMES = 30
+IDLE_FPS = 15
+# Journaled edits are flushed this often, and folded into the snapshot once
+# there are enough of them
+AUTOSAVE_MS = 5000
+COMPACT_AFTER = 100_000
 
 data_path = os.path.join(os.path.dirname(__file__), "data")
 
@@ -22,13 +76,65 @@ class GameState(Enum):
     LAST_MODE = 4
 
 
+def merge_rects(rects):
+    # Unite overlapping rects until none overlap any more
+    merged = []
+    for r in rects:
+        r = pg.Rect(r)
+        while (n := r.collidelist(merged)) != -1:
+            r.union_ip(merged.pop(n))
+        merged.append(r)
+    return merged
+
+
+def timing_stats(samples):
+    # Summary of a list of durations in seconds, in milliseconds
+    ms = np.asarray(samples, dtype=float) * 1000
+    if not len(ms):
+        return {}
+    return {
+        "mean": float(ms.mean()),
+        "p50": float(np.percentile(ms, 50)),
+        "p95": float(np.percentile(ms, 95)),
+        "p99": float(np.percentile(ms, 99)),
+        "max": float(ms.max()),
+    }
+
+
 class Game:
-    def __init__(self, save="world.json"):
+    # headless games draw to an offscreen surface and need no display, inputs
+    # defaults to the live keyboard and mouse. With dirty_rects frames only redraw
+    # and update what changed, see render. Binary saves keep at most stream_budget
+    # chunks in memory, see load
+    def __init__(
+        self,
+        save="world.isow",
+        headless=False,
+        inputs=None,
+        dirty_rects=False,
+        workers=0,
+        stream_budget=4096,
+    ):
+        self.headless = headless
+        self.dirty_rects = dirty_rects
+        # What the last frame showed, see find_dirty_rects
+        self.shown_view = None
+        self.shown_items = {}
+        self.idle = False
+        if headless:
+            os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
         pg.init()
         self.savefile: str = save
         print(f"Data Path: {data_path}")
-        self.window = pg.display.set_mode((WIDTH, HEIGHT))
-        pg.display.set_caption("Isometric")
+        if headless:
+            self.window = pg.Surface((WIDTH, HEIGHT))
+        else:
+            self.window = pg.display.set_mode((WIDTH, HEIGHT))
+            pg.display.set_caption("Isometric")
+        self.input = inputs if inputs is not None else LiveInput()
+        # Number of simulation steps taken
+        self.ticks = 0
+        self.profiler = FrameProfiler(PROFILE_PHASES)
         self.running = True
         self.clock = pg.time.Clock()
         self.sprite_cat = SpriteCatalogue()
@@ -44,7 +150,8 @@ class Game:
                     AnimatedSprite.from_files(
                         self.create_resource_list(
                             data_path, range(3, 5), pattern="tile{}"
-                        )
+                        ),
+                        updatecnt=120,
                     ),
                 )
             )
@@ -54,10 +161,25 @@ class Game:
         self.building_cat.add_sprites(
             Sprite.from_file(os.path.join(data_path, "city.png"), size=0.8)
         )
+        # Threads evaluating tile offsets, none with fewer than 2 workers
+        self.workers = workers
+        self.offset_pool = None
+        if workers > 1:
+            self.offset_pool = ThreadPoolExecutor(workers, "offsets")
         self.tiles = IsoTiles(self.sprite_cat)
-        self.cities = pg.sprite.Group()
+        self.tiles.use_pool(self.offset_pool, workers)
+        self.tiles.track_dirty = dirty_rects
+        # Set while the world is paged in from a binary save, see load
+        self.streamer: None | ChunkStreamer = None
+        self.stream_budget = stream_budget
+        # Logs the edits made since the last snapshot of a binary save
+        self.journal: None | EditJournal = None
+        self.last_autosave = 0
         self.pos = Vec2(0, 0)
+        # Camera position at the previous simulation step, see render
+        self.prev_pos = Vec2(0, 0)
         self.font = pg.font.SysFont("DejaVu", size=FONT_SIZE)
+        self.text = TextCache()
         self.mode = Cycle(0, GameState.LAST_MODE.value, 0)
         self.selected_effect = Cycle(start=0, modulus=3, offset=0)
         self.effect_types = [
@@ -68,10 +190,16 @@ class Game:
         self.zoom = 1.0
         self.editor_block_type = Cycle(0, self.max_types, 0)
         self.editor_flipped = False
-        self.editor_city = Building(self.building_cat, self.tiles, (0, 0))
-        
-        self.proj_grp = pg.sprite.Group()
-        self.player = Player(self.tiles, where=Vec2(0,0), proj_grp=self.proj_grp)
+        # Tile the city placer points at
+        self.city_placer = (0, 0)
+        # Buildings, projectiles and the player, drawn by the renderer of their kind
+        self.world = World()
+        self.renderers = {
+            BUILDING: BuildingRenderer(self.building_cat, self.tiles),
+            PROJECTILE: ProjectileRenderer(self.tiles),
+            PLAYER: PlayerRenderer(self.tiles),
+        }
+        self.player = Player(self.world, where=Vec2(0,0))
 
     @staticmethod
     def create_resource_list(dir, ran, pattern="sprite{}", ext="png"):
@@ -82,6 +210,7 @@ class Game:
         return names
 
     def draw_str(self, x, y, text, col=(200, 200, 200)):
+        # For text that changes all the time, everything else goes through draw_text
         surf = self.font.render(text, True, col)
         dest = surf.get_rect()
         dest.x = x
@@ -94,45 +223,86 @@ class Game:
             self.window, snap, self.editor_block_type.get(), self.editor_flipped, True
         )
 
-    def draw_city_placer(self, pos):
-        iso_snap = self.tiles.screen_to_iso(pos)
-        self.editor_city.coord = iso_snap
-        self.editor_city.draw(self.window, trans=True)
+    def block_placer_state(self, pos):
+        snap = self.tiles.iso_to_screen(self.tiles.screen_to_iso(pos))
+        block = (self.editor_block_type.get(), self.editor_flipped)
+        sprite = self.sprite_cat.get(*block, True)
+        return pg.Rect((int(snap.x), int(snap.y)), sprite.get_size()), block
 
-    def draw_text(self, x, y, text, sep=FONT_SIZE):
+    def draw_city_placer(self, pos):
+        self.city_placer = self.tiles.screen_to_iso(pos)
+        lift = self.tiles.get_tile_offset(self.city_placer)
+        self.renderers[BUILDING].draw(self.window, self.city_placer, lift, trans=True)
+
+    def draw_text(self, x, y, text, sep=FONT_SIZE, col=(200, 200, 200), cached=True):
+        # Cached text is rendered once as a whole and reused while it is unchanged
+        if cached:
+            self.window.blit(self.text.block(self.font, text, col, sep), (x, y))
+            return
         for line in text.splitlines():
-            self.draw_str(x, y, line)
+            self.draw_str(x, y, line, col)
             y = y + sep
 
-    def draw_ui(self, pos):
-        menu_top = 20
-        self.draw_text(WIDTH - 60, menu_top, f"FPS: {int(self.clock.get_fps())}")
+    def fps_text(self):
+        return f"FPS: {int(self.clock.get_fps())}"
+
+    def help_text(self):
         match self.mode.get():
             case 0:
-                self.draw_text(
-                    20,
-                    10,
+                return (
                     "Effect Mode\n"
                     "LMB: Spawn Effect\n"
                     "N/P: Next Effect/Previous Effect\n"
                     f"Selected Effect {self.effect_types[self.selected_effect.get()]}"
-                    "Mode Switch: M",
+                    "Mode Switch: M"
                 )
             case 1:
-                self.draw_text(
-                    20,
-                    10,
+                return (
                     "Build Mode\n"
                     "Scrollwheel: Move Block Up/Down\n"
                     "Change Block Type: RMB\n"
-                    "Rotate Block: R\n",
+                    "Rotate Block: R\n"
                 )
+            case 2:
+                return "City Place Mode\n" "LMB: Place City\n"
+            case 3:
+                return "Play Mode"
+
+    def draw_ui(self, pos):
+        menu_top = 20
+        self.draw_str(WIDTH - 60, menu_top, self.fps_text())
+        self.draw_text(20, 10, self.help_text())
+        match self.mode.get():
+            case 1:
                 self.draw_block_placer(pos)
             case 2:
-                self.draw_text(20, 10, "City Place Mode\n" "LMB: Place City\n")
                 self.draw_city_placer(pos)
-            case 3:
-                self.draw_text(20,10,"Play Mode")
+        if self.profiler.visible:
+            self.draw_text(WIDTH - 260, 40, self.profiler.report(), cached=False)
+
+    def ui_state(self, pos):
+        # The parts of the UI by name, with their screen rect and what they show
+        fps = self.fps_text()
+        state = {"fps": (pg.Rect((WIDTH - 60, 20), self.font.size(fps)), fps)}
+        text = self.help_text()
+        panel = self.text.block(self.font, text, (200, 200, 200), FONT_SIZE)
+        state["help"] = (panel.get_rect(topleft=(20, 10)), text)
+        match self.mode.get():
+            case 1:
+                state["placer"] = self.block_placer_state(pos)
+            case 2:
+                self.city_placer = self.tiles.screen_to_iso(pos)
+                lift = self.tiles.get_tile_offset(self.city_placer)
+                state["placer"] = self.renderers[BUILDING].screen_state(
+                    self.city_placer, lift, BuildingRenderer.MAX_HP, trans=True
+                )
+        if self.profiler.visible:
+            report = self.profiler.report()
+            lines = report.splitlines()
+            width = max(self.font.size(line)[0] for line in lines)
+            height = FONT_SIZE * len(lines) + FONT_SIZE
+            state["profiler"] = (pg.Rect(WIDTH - 260, 40, width, height), report)
+        return state
 
     # Given two groups of Elements with a coord member, check if they are on the same isotiles
     # Returns a list of tuples of colliding elements
@@ -144,41 +314,134 @@ class Game:
     #                collision_pairs.append((g1,g2))
     #    return collision_pairs
 
-    def render(self):
-        # Update relative position
-        self.tiles.set_origin(-self.pos)
-        self.window.fill((0, 80, 180))
-        self.tiles.draw(self.window)
-        for c in self.cities:
-            c.draw(self.window)
-        for s in self.proj_grp:
-            s.scale = self.zoom
-            s.draw(self.window)
-        self.player.draw(self.window)
-        self.draw_ui(Vec2(pg.mouse.get_pos()))
+    def render(self, alpha=1.0):
+        # alpha is how far the frame lies between the last two simulation steps.
+        # Returns the rects of the window that have been redrawn, None if all of
+        # it has been
+        self.tiles.set_origin(-self.prev_pos.lerp(self.pos, alpha))
+        interpolation(self.world, alpha)
+        offset_following(self.world, self.tiles)
+        self.renderers[PROJECTILE].scale = self.zoom
+        rects = self.find_dirty_rects() if self.dirty_rects else None
+        if rects is None:
+            self.draw_scene()
+            return None
+        # Everything overlapping a changed rect is drawn again, clipped to it
+        for r in rects:
+            self.window.set_clip(r)
+            self.draw_scene()
+        self.window.set_clip(None)
+        return rects
+
+    def draw_scene(self):
+        self.window.fill(BACKGROUND)
+        # Everything standing on the map is drawn in depth order with the tiles
+        with self.profiler.section("tiles"):
+            actors = drawables(self.world, self.renderers, self.window.get_clip())
+            self.tiles.draw(self.window, actors)
+        with self.profiler.section("ui"):
+            self.draw_ui(Vec2(self.input.mouse_pos()))
+
+    def find_dirty_rects(self):
+        # Parts of the window that look different than in the last frame, None if
+        # it is better to redraw all of it
+        view = self.window.get_rect()
+        shown = (
+            Vec2(self.tiles.orig),
+            self.sprite_cat.generation,
+            self.building_cat.generation,
+            self.tiles,
+        )
+        items = screen_states(self.world, self.renderers, view)
+        items.update(self.ui_state(Vec2(self.input.mouse_pos())))
+        rects = self.tiles.take_dirty_rects(view)
+        last, self.shown_items = self.shown_items, items
+        if shown != self.shown_view:
+            self.shown_view = shown
+            self.idle = False
+            return None
+        changed = [k for k in items.keys() | last.keys() if items.get(k) != last.get(k)]
+        # A changing FPS counter alone does not keep the game from idling
+        self.idle = not rects and all(k == "fps" for k in changed)
+        for k in changed:
+            rects.extend(item[0] for item in (items.get(k), last.get(k)) if item)
+        rects = merge_rects(r.clip(view) for r in rects)
+        rects = [r for r in rects if r.width and r.height]
+        area = sum(r.width * r.height for r in rects)
+        if len(rects) > MAX_DIRTY_RECTS:
+            return None
+        if area > FULL_REDRAW_AREA * view.width * view.height:
+            return None
+        return rects
 
     # Save the current game state to a file that can be loaded with the load method
+    # Files ending in .json use the JSON format, everything else the binary one
     def save(self, filename):
         print("Saving")
-        jstr = self.tiles.to_json()
-        with open(filename, "w") as sfile:
-            sfile.write(jstr)
-
+        if filename.endswith(".json"):
+            if self.streamer:
+                jstr = dumps_tiles(*chunk_tiles(self.streamer.all_chunks()))
+            else:
+                jstr = self.tiles.to_json()
+            with open(filename, "w") as sfile:
+                sfile.write(jstr)
+        elif self.journal is not None and self.journal.snapshot == filename:
+            # The snapshot and the journal already hold everything but the
+            # latest edits
+            self.journal.flush(sync=True)
+        else:
+            if self.journal is not None:
+                self.journal.close()
+            if self.streamer:
+                self.streamer.save(filename)
+            else:
+                self.tiles.to_binary(filename)
+            self.journal = EditJournal(filename, truncate=True)
+            self.tiles.journal = self.journal
+
+    def autosave(self):
+        now = pg.time.get_ticks()
+        if now - self.last_autosave >= AUTOSAVE_MS:
+            self.last_autosave = now
+            self.journal.flush()
+            if self.journal.count >= COMPACT_AFTER:
+                self.journal.compact()
+
+    # Binary saves are streamed in by a ChunkStreamer while the game keeps running
     def load(self, filename):
         print("Loading")
-        with open(filename, "r") as sfile:
-            jstr = sfile.read()
-        self.tiles = IsoTiles.from_json(self.sprite_cat, jstr)
-        self.player.iso_tiles = self.tiles
+        if self.streamer:
+            self.streamer.close()
+            self.streamer = None
+        if self.journal is not None:
+            self.journal.close()
+            self.journal = None
+        if filename.endswith(".json"):
+            with open(filename, "r") as sfile:
+                jstr = sfile.read()
+            self.tiles = IsoTiles.from_json(self.sprite_cat, jstr)
+        else:
+            # Replay the edits journaled since the snapshot while streaming it in
+            edits = TileEdits.read(*journal_files(filename))
+            self.tiles = IsoTiles(self.sprite_cat)
+            self.streamer = ChunkStreamer(
+                self.tiles, filename, self.stream_budget, edits=edits
+            )
+            self.journal = EditJournal(filename)
+            self.tiles.journal = self.journal
+        self.tiles.use_pool(self.offset_pool, self.workers)
+        self.tiles.track_dirty = self.dirty_rects
+        for renderer in self.renderers.values():
+            renderer.tiles = self.tiles
 
     def mode_effect_controls(self, e):
         if e.type == pg.MOUSEWHEEL:
-            self.zoom = max(0,min(self.zoom + e.y * 0.1,2))
+            self.zoom = max(0.1,min(self.zoom + e.y * 0.1,2))
             self.sprite_cat.scale_catalogue(self.zoom)
             self.building_cat.scale_catalogue(self.zoom)
-            self.player.scale = self.zoom
+            self.renderers[PLAYER].scale = self.zoom
         if e.type == pg.MOUSEBUTTONDOWN and e.button == 1:
-            pos = pg.mouse.get_pos()
+            pos = self.input.mouse_pos()
             tile = self.tiles.screen_to_iso(Vec2(pos))
             effect = self.effect_types[self.selected_effect.get()](
                 amplitude=1.5,
@@ -198,7 +461,7 @@ class Game:
             self.save(self.savefile)
         if e.type == pg.KEYDOWN and e.key == pg.K_l:
             self.load(self.savefile)
-        pos = Vec2(pg.mouse.get_pos())
+        pos = Vec2(self.input.mouse_pos())
         if e.type == pg.MOUSEWHEEL and e.y > 0:
             self.editor_block_type.cycle_up()
         if e.type == pg.MOUSEWHEEL and e.y < 0:
@@ -220,17 +483,13 @@ class Game:
 
     def mode_city_build_controls(self, e):
         if e.type == pg.MOUSEBUTTONDOWN and e.button == 1:
-            # Editor item location gets updated every frame
-            self.editor_city.iso_tiles = self.tiles
-            self.cities.add(self.editor_city)
-            self.editor_city = Building(
-                self.building_cat, self.tiles, self.editor_city.coord
-            )
+            # The placer location gets updated every frame
+            spawn_building(self.world, self.city_placer)
 
-    def camera_control(self):
+    def camera_control(self, dt):
         # Camera Movement
-        pressed = pg.key.get_pressed()
-        speed = 3
+        pressed = self.input.pressed()
+        speed = CAMERA_SPEED * dt
         if pressed[pg.K_a]:
             self.pos.x -= speed
         if pressed[pg.K_d]:
@@ -243,14 +502,26 @@ class Game:
     def mode_play_controls(self, e):
         self.player.input(e)
 
-    def update(self):
-        self.sprite_cat.update()
-        self.proj_grp.update()
-        for e in pg.event.get():
+    def poll(self):
+        # Once per frame, rendered or not: input, paging and autosaving
+        with self.profiler.section("events"):
+            self.handle_events()
+        if self.streamer:
+            with self.profiler.section("streaming"):
+                center = self.tiles.screen_to_iso(Vec2(WIDTH / 2, HEIGHT / 2))
+                self.streamer.update(center)
+        if self.journal is not None:
+            with self.profiler.section("autosave"):
+                self.autosave()
+
+    def handle_events(self):
+        for e in self.input.events(self.ticks):
             if e.type == pg.QUIT:
                 self.running = False
             if e.type == pg.KEYDOWN and e.key == pg.K_m:
                 self.mode.cycle_down()
+            if e.type == pg.KEYDOWN and e.key == PROFILER_KEY:
+                self.profiler.toggle()
             match self.mode.get():
                 case GameState.EFFECT_MODE.value:
                     self.mode_effect_controls(e)
@@ -260,89 +531,218 @@ class Game:
                     self.mode_city_build_controls(e)
                 case GameState.PLAY_MODE.value:
                     self.mode_play_controls(e)
-        if self.mode.get() != GameState.PLAY_MODE.value:
-            self.camera_control()
-        if self.mode.get() == GameState.PLAY_MODE.value:
-            self.player.update()
-        self.cities.update(self.proj_grp)
-        self.tiles.update()
-
-    def run(self):
+
+    def update(self, dt=SIM_DT):
+        # Advance the simulation by dt seconds
+        self.ticks += 1
+        self.prev_pos = Vec2(self.pos)
+        profile = self.profiler.section
+        with profile("sprites"):
+            self.sprite_cat.update(dt)
+        with profile("movement"):
+            movement(self.world, dt)
+            screen_culling(self.world, self.tiles, (WIDTH, HEIGHT))
+        playing = self.mode.get() == GameState.PLAY_MODE.value
+        with profile("player"):
+            if not playing:
+                self.camera_control(dt)
+            self.player.update(dt, self.input.pressed() if playing else None)
+        with profile("collisions"):
+            self.check_collisions()
+        with profile("effects"):
+            self.tiles.update(dt)
+
+    def check_collisions(self):
+        # Destroyed buildings go off with a shockwave
+        collisions(self.world)
+        for coord in deaths(self.world):
+            effect = CircularWaveAnimation(
+                amplitude=1, ahead=1, trail=1, epicenter=coord
+            )
+            self.tiles.animations.add(effect)
+
+    def run(self, fps=60, drop_frames=False):
+        # fps caps the render rate, 0 renders as fast as possible
+        behind = 0.0
+        skipped = 0
+        idle = 0
+        last = time.perf_counter()
         while self.running:
-            self.update()
+            now = time.perf_counter()
+            behind += now - last
+            last = now
+            self.poll()
+            steps = 0
+            while behind >= SIM_DT and steps < MAX_STEPS:
+                self.update(SIM_DT)
+                behind -= SIM_DT
+                steps += 1
+            if behind >= SIM_DT:
+                if drop_frames and skipped < MAX_SKIP:
+                    skipped += 1
+                    self.profiler.end_frame()
+                    continue
+                # Too far behind, let the game slow down instead
+                behind %= SIM_DT
+            skipped = 0
+            rects = self.render(behind / SIM_DT)
+            with self.profiler.section("display"):
+                if rects is None:
+                    pg.display.update()
+                elif rects:
+                    pg.display.update(rects)
+            self.profiler.end_frame()
+            idle = idle + 1 if self.dirty_rects and self.idle else 0
+            self.clock.tick(IDLE_FPS if idle >= IDLE_FRAMES else fps)
+        self.close()
+
+    def run_headless(self, ticks):
+        # Run ticks simulation steps as fast as possible, rendering each one
+        # offscreen, and return how long the parts of every step took
+        timings = {"poll": [], "update": [], "render": []}
+        for _ in range(ticks):
+            if not self.running:
+                break
+            t0 = time.perf_counter()
+            self.poll()
+            t1 = time.perf_counter()
+            self.update(SIM_DT)
+            t2 = time.perf_counter()
             self.render()
-            pg.display.update()
-            self.clock.tick(60)
-
-class Projectile(pg.sprite.Sprite):
-    SIZE = 10
-    def __init__(self, direction: Vec2, pos: Vec2, tiles, scale=1.0):
-        super().__init__()
-        self.dir = direction
-        self.scale = scale
-        self.coord = pos
-        self.tiles: IsoTiles = tiles
-
-    def update(self):
-        self.coord += TAU * self.dir
-        at = self.tiles.iso_to_screen(self.coord)
-        if at.x > WIDTH or at.x < 0 or at.y > HEIGHT or at.y < 0:
-            self.kill()
-
-    def draw(self, srf):
-        at = self.tiles.iso_to_screen(self.coord)
-        pg.draw.circle(srf, (200,0,0), at, self.scale * self.SIZE)
-
-class Player(pg.sprite.Sprite):
-    ORIG_WIDTH = 20
-    ORIG_HEIGHT = 40
-    CD_MAX = 60
-    def __init__(self, tiles, proj_grp, where=Vec2(0,0)):
-        self.coord: Vec2 = Vec2(where)
-        self.iso_tiles = tiles
-        self.scale = 1.0
-        self.speed = 0.1
+            t3 = time.perf_counter()
+            timings["poll"].append(t1 - t0)
+            timings["update"].append(t2 - t1)
+            timings["render"].append(t3 - t2)
+            self.profiler.end_frame()
+        return timings
+
+    def state_digest(self):
+        # Hash of the simulated state, equal for runs of the same script
+        h = hashlib.sha256()
+        if self.streamer:
+            chunks = self.streamer.all_chunks()
+        else:
+            chunks = self.tiles.chunks.values()
+        for c in sorted(chunks, key=lambda c: c.key):
+            h.update(repr(c.key).encode())
+            h.update(c.types.tobytes())
+            h.update(c.flags.tobytes())
+            if c.offsets is not None:
+                h.update(c.offsets.tobytes())
+        w = self.world
+        cities = w.rows(POSITION | HEALTH, BUILDING)
+        state = [
+            self.ticks,
+            tuple(self.pos),
+            tuple(self.player.coord),
+            sorted(zip(map(tuple, w.pos[cities].tolist()), w.hp[cities].tolist())),
+            sorted(map(tuple, w.pos[w.rows(POSITION, PROJECTILE)].tolist())),
+            sorted(
+                (type(a).__name__, a.time, a.amplitude)
+                for a in self.tiles.animations
+            ),
+        ]
+        h.update(repr(state).encode())
+        return h.hexdigest()
+
+    def close(self):
+        if self.streamer:
+            self.streamer.close()
+        if self.journal is not None:
+            self.journal.close()
+        self.input.close()
+        self.profiler.close()
+        if self.offset_pool is not None:
+            self.offset_pool.shutdown()
+
+class Player:
+    # Steers the player entity of the world
+    __slots__ = ("world", "row", "speed", "cd", "facing")
+    # Seconds between two shots
+    CD_MAX = 1.0
+    FACINGS = (Vec2(1, 0), Vec2(0, 1), Vec2(-1, 0), Vec2(0, -1))
+
+    def __init__(self, world: World, where=Vec2(0,0)):
+        self.world = world
+        self.row = world.spawn(
+            POSITION | RENDERABLE, pos=where, anchor=(0, 1), kind=PLAYER
+        )
+        self.speed = PLAYER_SPEED
         self.cd = self.CD_MAX
-        self.proj_grp = proj_grp
         self.facing = 0
 
-    def draw(self, srf):
-        pos = self.iso_tiles.iso_to_screen(self.coord)
-        col = pg.Color(128,128,60)
-        dst = pg.Rect((int(pos.x),int(pos.y)), (self.scale*self.ORIG_WIDTH, self.scale*self.ORIG_HEIGHT))
-        pg.draw.rect(srf, col, dst)
+    @property
+    def coord(self):
+        return Vec2(self.world.pos[self.row].tolist())
 
-    def update(self):
-        self.moveupdate()
-        self.cd = max(0, self.cd - 1)
+    def update(self, dt, pressed=None):
+        # pressed holds the keys steering the player, None while not playing
+        if pressed is not None:
+            self.moveupdate(dt, pressed)
+            self.cd = max(0, self.cd - dt)
 
     def shoot(self):
         if self.cd <= 0:
-            # Shoot projectile
-            facings = [Vec2(1,0), Vec2(0,1), Vec2(-1,0), Vec2(0,-1)]
-            self.proj_grp.add(Projectile(facings[self.facing], self.coord.copy(), self.iso_tiles, self.scale))
+            spawn_projectile(self.world, self.FACINGS[self.facing], self.coord)
 
     def input(self, e):
         if e.type == pg.KEYDOWN and e.key == pg.K_SPACE:
             self.shoot()
-        
 
-    def moveupdate(self):
-        pressed = pg.key.get_pressed()
+    def moveupdate(self, dt, pressed):
+        step = self.speed * dt
+        pos = self.world.pos[self.row]
         if pressed[pg.K_a]:
-            self.coord.x -= self.speed
+            pos[0] -= step
             self.facing = 2
         if pressed[pg.K_d]:
-            self.coord.x += self.speed
+            pos[0] += step
             self.facing = 0
         if pressed[pg.K_w]:
-            self.coord.y -= self.speed
+            pos[1] -= step
             self.facing = 3
         if pressed[pg.K_s]:
-            self.coord.y += self.speed
+            pos[1] += step
             self.facing = 1
 
 
+class PlayerRenderer:
+    ORIG_WIDTH = 20
+    ORIG_HEIGHT = 40
+    COLOR = pg.Color(128, 128, 60)
+
+    def __init__(self, tiles):
+        self.tiles = tiles
+        self.scale = 1.0
+
+    def size(self):
+        return (self.scale * self.ORIG_WIDTH, self.scale * self.ORIG_HEIGHT)
+
+    def extent(self):
+        w, h = self.size()
+        return (0, 0, w + 1, h + 1)
+
+    def rect(self, at):
+        pos = self.tiles.iso_to_screen(at)
+        return pg.Rect((int(pos.x), int(pos.y)), self.size())
+
+    def draw(self, srf, rect):
+        pg.draw.rect(srf, self.COLOR, rect)
+
+    def actors(self, world: World, rows) -> list[Drawable]:
+        tiles = world.tiles_of(rows).tolist()
+        return [
+            Drawable(tuple(tile), self.draw, self.rect(at))
+            for tile, at in zip(tiles, world.draw_pos[rows].tolist())
+        ]
+
+    def screen_states(self, world: World, rows) -> dict:
+        return {
+            ("player", row): (self.rect(at),)
+            for row, at in zip(rows.tolist(), world.draw_pos[rows].tolist())
+        }
+
+
 
 #class Robot(pg.sprite.Sprite):
 #    def __init__(self, idle, walking, cmnd):
@@ -381,4 +781,68 @@ class Player(pg.sprite.Sprite):
 #        srf.blit(img, dst)
 
 
-Game().run()
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Isometric tile game")
+    parser.add_argument("--save", default="world.isow", help="world file to save to")
+    parser.add_argument(
+        "--fps", type=int, default=60, help="frame rate cap, 0 for none"
+    )
+    parser.add_argument(
+        "--drop-frames", action="store_true", help="skip frames to keep up"
+    )
+    parser.add_argument("--record", help="record the input to this script")
+    parser.add_argument("--script", help="replay the input from this script")
+    parser.add_argument(
+        "--headless", action="store_true", help="simulate without a window"
+    )
+    parser.add_argument(
+        "--ticks", type=int, help="headless steps, by default to the script's end"
+    )
+    parser.add_argument(
+        "--stats", help="write headless timings and state digest to this JSON file"
+    )
+    parser.add_argument(
+        "--profile", help="stream per-frame phase timings to this CSV file"
+    )
+    parser.add_argument(
+        "--dirty-rects", action="store_true", help="only redraw what changed"
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=0,
+        help="threads evaluating tile offsets, e.g. one per core",
+    )
+    parser.add_argument(
+        "--stream-budget",
+        type=int,
+        default=4096,
+        help="chunks of a binary save to keep in memory",
+    )
+    args = parser.parse_args()
+    inputs = ScriptedInput(args.script) if args.script else LiveInput(args.record)
+    game = Game(
+        args.save,
+        headless=args.headless,
+        inputs=inputs,
+        dirty_rects=args.dirty_rects,
+        workers=args.workers,
+        stream_budget=args.stream_budget,
+    )
+    if args.profile:
+        game.profiler.stream_to(args.profile)
+    if not args.headless:
+        game.run(args.fps, args.drop_frames)
+        sys.exit()
+    ticks = args.ticks
+    if ticks is None:
+        ticks = inputs.last_tick + 1 if args.script else 600
+    timings = game.run_headless(ticks)
+    stats = {"ticks": game.ticks, "digest": game.state_digest()}
+    stats.update({part: timing_stats(t) for part, t in timings.items()})
+    game.close()
+    if args.stats:
+        with open(args.stats, "w") as sfile:
+            json.dump(stats, sfile, indent=2)
+    else:
+        print(json.dumps(stats, indent=2))
@@ -0,0 +1,101 @@
+import json
+from collections import defaultdict
+import pygame as pg
+
+# Events that are recorded and replayed, with the attributes kept for each.
+# Scripts hold one JSON object per line, e.g.
+#   {"tick": 12, "event": "KEYDOWN", "key": "m"}
+# keys are given by their pygame name, positions as [x, y]
+EVENT_ATTRS = {
+    "QUIT": (),
+    "KEYDOWN": ("key",),
+    "KEYUP": ("key",),
+    "MOUSEMOTION": ("pos",),
+    "MOUSEBUTTONDOWN": ("pos", "button"),
+    "MOUSEBUTTONUP": ("pos", "button"),
+    "MOUSEWHEEL": ("x", "y"),
+}
+
+
+class LiveInput:
+    # Keyboard and mouse, optionally recorded to a script for ScriptedInput
+    def __init__(self, record=None):
+        self.record = open(record, "w") if record else None
+        self.names = {getattr(pg, name): name for name in EVENT_ATTRS}
+
+    def events(self, tick):
+        events = pg.event.get()
+        if self.record:
+            for e in events:
+                if (name := self.names.get(e.type)) is None:
+                    continue
+                rec = {"tick": tick, "event": name}
+                for attr in EVENT_ATTRS[name]:
+                    value = getattr(e, attr)
+                    rec[attr] = pg.key.name(value) if attr == "key" else value
+                self.record.write(json.dumps(rec) + "\n")
+        return events
+
+    def pressed(self):
+        return pg.key.get_pressed()
+
+    def mouse_pos(self):
+        return pg.mouse.get_pos()
+
+    def close(self):
+        if self.record:
+            self.record.close()
+
+
+class ScriptedInput:
+    # Replays a recorded script. The events of a tick are handed out exactly once,
+    # by the first call of events for that tick or a later one, however many
+    # frames poll in between
+    def __init__(self, filename):
+        self.script: dict[int, list[dict]] = {}
+        with open(filename, "r") as sfile:
+            for line in sfile:
+                if line.strip():
+                    rec = json.loads(line)
+                    self.script.setdefault(rec.pop("tick"), []).append(rec)
+        self.last_tick = max(self.script, default=-1)
+        # Ticks with events in order, the ones before next have been handed out
+        self.ticks = sorted(self.script)
+        self.next = 0
+        self.held: set[int] = set()
+        self.pos = (0, 0)
+
+    def events(self, tick):
+        events = []
+        while self.next < len(self.ticks) and self.ticks[self.next] <= tick:
+            events += map(self.replay, self.script[self.ticks[self.next]])
+            self.next += 1
+        return events
+
+    def replay(self, rec) -> pg.event.Event:
+        attrs = {}
+        for attr in EVENT_ATTRS[rec["event"]]:
+            value = rec[attr]
+            if attr == "key":
+                value = pg.key.key_code(value)
+            elif isinstance(value, list):
+                value = tuple(value)
+            attrs[attr] = value
+        e = pg.event.Event(getattr(pg, rec["event"]), attrs)
+        if e.type == pg.KEYDOWN:
+            self.held.add(e.key)
+        elif e.type == pg.KEYUP:
+            self.held.discard(e.key)
+        if "pos" in attrs:
+            self.pos = attrs["pos"]
+        return e
+
+    def pressed(self):
+        # Indexed by key like pg.key.get_pressed
+        return defaultdict(bool, dict.fromkeys(self.held, True))
+
+    def mouse_pos(self):
+        return self.pos
+
+    def close(self):
+        pass
@@ -1,64 +1,480 @@
 import pygame as pg
+import numpy as np
 from pygame.math import Vector2 as Vec2
-import json
+from collections import OrderedDict
 from sprites import SpriteCatalogue
-from math import floor
-from effects import CircularWaveAnimation
+from math import ceil, floor
+from itertools import repeat
+from concurrent.futures import Executor
+from chunks import CHUNK_SIZE, EMPTY, FLIPPED, TileChunk, chunk_key
+from chunks import chunk_tiles, fill_chunks
+from worldio import WorldFile, dumps_tiles, loads_tiles, write_world
+from effects import TileAnimation
+from entities import EntityGroup
+from ecs import BUILDING, HEALTH, OFFSET_FOLLOWER, POSITION, RENDERABLE
+from ecs import Drawable, World, tile_keys
+
+
+BUILDING_COMPONENTS = POSITION | HEALTH | RENDERABLE | OFFSET_FOLLOWER
 
 
 class IsoTiles:
     MAXCNT = 60
+    # Upper bound on the memory used by pre-rendered chunk surfaces, and on the
+    # surface of a single chunk. Chunks too big to bake are drawn tile by tile
+    BAKE_BUDGET = 64 * 1024 * 1024
+    BAKE_CHUNK_BYTES = 16 * 1024 * 1024
+    # Fewest tiles worth handing to a worker of the offset pool
+    STRIP_TILES = 8192
 
     def __init__(self, sprites: SpriteCatalogue):
         self.sprites: SpriteCatalogue = sprites
         # All sprites should have the same dimension, or the isometric effect won't work
         # self.s_w = self.sprites[0].get_width()
         # self.s_h = self.sprites[0].get_height()
-        self.tile_offsets = {}
-        self.tile_type = {}
-        self.animations = pg.sprite.Group()
+        self.animations = EntityGroup()
         self.framecnt = self.MAXCNT
         self.orig: Vec2 = Vec2(0, 0)
-        self.flipped = set()
+        # (origin x, origin y, tile width, tile height) as of the catalogue
+        # generation, see projection
+        self.proj: tuple[float, float, int, int] | None = None
+        self.proj_generation = self.sprites.generation
+        # Active effects bucketed by the chunks they can reach, rebuilt on update
+        self.effect_index: dict[tuple[int, int], list[TileAnimation]] = {}
+        self.unbounded_effects: list[TileAnimation] = []
+        # How far effects can move tiles up or down, in tile offset units: per
+        # chunk, at most in any chunk and everywhere. stored_lift is the same for
+        # the offsets stored in the chunks, see TileChunk.lift
+        self.effect_lift: dict[tuple[int, int], float] = {}
+        self.max_effect_lift = 0.0
+        self.unbounded_lift = 0.0
+        self.stored_lift = 0.0
+        # Offsets for the current frame, per chunk in draw order, and for lookups
+        # outside of any chunk. Reset by update so every consumer agrees on them
+        self.frame_field: dict[tuple[int, int], np.ndarray] = {}
+        self.frame_memo: dict = {}
+        # The world itself, split into dense chunks of tiles
+        self.chunks: dict[tuple[int, int], TileChunk] = {}
+        # Keys of the chunks edited since they were created or loaded
+        self.modified: set[tuple[int, int]] = set()
+        # Receives every tile edit when set, see journal.EditJournal
+        self.journal = None
+        # Memory used by pre-rendered chunk surfaces, least recently drawn first
+        self.baked: OrderedDict[tuple[int, int], int] = OrderedDict()
+        self.baked_bytes = 0
+        self.baked_generation = self.sprites.generation
+        # Chunks that may look different since take_dirty_rects was last called,
+        # besides the ones effects reach, only recorded while track_dirty is set
+        self.track_dirty = False
+        self.dirty: set[tuple[int, int]] = set()
+        self.dirty_tiles: set[tuple[int, int]] = set()
+        # Where the chunks effects reached on the last call were drawn back then
+        self.reached: list[pg.Rect] = []
+        self.animation_stamp = self.sprites.animation_stamp
+        # Evaluates offsets in strips when set, see use_pool
+        self.pool: None | Executor = None
+        self.pool_size = 1
 
     def to_json(self):
-        tile_loc = list(self.tile_type.keys())
-        tile_t = list(self.tile_type.values())
-        flipped = list(self.flipped)
-        s = {"tile_loc": tile_loc, "tile_type": tile_t, "flipped": flipped}
-        return json.dumps(s)
+        return dumps_tiles(*self.get_tiles())
 
     @classmethod
     def from_json(cls, sprites: SpriteCatalogue, json_str: str):
         itiles = cls(sprites)
-        d = json.loads(json_str)
-        for (
-            k,
-            v,
-        ) in zip(d["tile_loc"], d["tile_type"]):
-            ktup = (k[0], k[1])
-            itiles.tile_type[ktup] = v
-        for f in d["flipped"]:
-            itiles.flipped.add((f[0], f[1]))
+        itiles.add_tiles(*loads_tiles(json_str))
         return itiles
 
-    def set_origin(self, orig: Vec2):
-        self.orig = orig
+    def to_binary(self, filename, compress=True):
+        write_world(filename, self.chunks.values(), compress)
 
+    @classmethod
+    def from_binary(cls, sprites: SpriteCatalogue, filename, edits=None):
+        # edits are replayed on top of the stored chunks, see journal.TileEdits
+        itiles = cls(sprites)
+        with WorldFile(filename) as world:
+            itiles.load_chunks(world, world.keys())
+        if edits is not None:
+            for key in edits.keys():
+                itiles.set_chunk(edits.apply(itiles.chunks.get(key) or TileChunk(key)))
+        return itiles
+
+    def load_chunks(self, world: WorldFile, keys):
+        # Page in chunks from a save file
+        for key in keys:
+            self.set_chunk(world.read_chunk(key))
+
+    def set_chunk(self, chunk: TileChunk):
+        self.drop_chunk(chunk.key)
+        if chunk:
+            self.chunks[chunk.key] = chunk
+            self.stored_lift = max(self.stored_lift, chunk.lift)
+
+    def drop_chunk(self, key):
+        # Forget a chunk without counting it as an edit, e.g. to page it out
+        self.unbake(key)
+        self.frame_field.pop(key, None)
+        if self.track_dirty:
+            self.dirty.add(key)
+        self.chunks.pop(key, None)
+
+    def get_tiles(self):
+        # All tiles as (N, 2) coordinates, types and flipped flags
+        return chunk_tiles(self.chunks.values())
+
+    def add_tiles(self, coords, types, flipped=False):
+        # Vectorized add_tile for an (N, 2) array of coordinates
+        for chunk in fill_chunks(self.chunks, coords, types, flipped):
+            self.invalidate_tile((chunk.i0, chunk.j0))
+        if self.journal is not None:
+            coords = np.asarray(coords).reshape(-1, 2)
+            flags = np.where(np.broadcast_to(flipped, len(coords)), FLIPPED, 0)
+            self.journal.record_many(coords, types, flags)
+
+    def set_origin(self, orig: Vec2):
+        # Snapped to whole pixels, so tiles drawn one by one line up with the baked
+        # chunks however the camera moves
+        self.orig = Vec2(floor(orig.x), floor(orig.y))
+        self.proj = None
 
     def set_scale(self, scale=1.0):
         self.sprites.scale_catalogue(scale)
-        self.s_w = self.sprites[0].get_width()
-        self.s_h = self.sprites[0].get_height()
-
-    def draw(self, surf):
-        for tileindex in sorted(self.tile_type.keys()):
-            v = self.tile_to_screen(tileindex)
-            if sprite := self.get_tile_sprite(tileindex):
-                surf.blit(sprite, pg.Rect(v.x, v.y, 0, 0))
-        # Always draw Buildings after the landscape has been drawn
-        # for tileindex in sorted(self.buildings):
-        #    self.buildings[tileindex].draw(surf, self.iso_to_screen(tileindex, offset=-0.4))
+        self.proj = None
+        self.drop_baked()
+
+    def projection(self):
+        # Everything iso_to_screen and screen_to_iso need, read from the first
+        # sprite only when the origin or the scale of the catalogue has changed
+        if self.proj is None or self.proj_generation != self.sprites.generation:
+            sprite = self.sprites[0]
+            self.proj = (
+                self.orig.x,
+                self.orig.y,
+                sprite.get_width(),
+                sprite.get_height(),
+            )
+            self.proj_generation = self.sprites.generation
+        return self.proj
+
+    def draw(self, surf, actors=()):
+        # actors have a tile they stand on and a draw(surf) method, they are drawn
+        # right after that tile, in front of the tiles behind them
+        if self.baked_generation != self.sprites.generation:
+            # The catalogue has been rescaled behind our back
+            self.drop_baked()
+        # Only what falls into the clipping area gets drawn
+        visible = self.visible_chunks(surf.get_clip())
+        actors = self.depth_sort(actors)
+        actor_keys = {a[0] for a in actors}
+        static = {chunk.key for chunk in visible if self.is_static_chunk(chunk)}
+        # Chunks with actors on them are drawn tile by tile, but stay baked
+        baked = self.bake_plan(
+            [c for c in visible if c.key in static and c.key not in actor_keys]
+        )
+        per_tile = [c for c in visible if c.key not in baked]
+        self.fill_field(per_tile)
+        # Tiles come from the atlas, and everything between two actors is drawn
+        # with a single blits call
+        areas = self.sprites.atlas_areas()
+        tiles = self.tile_blits(
+            per_tile, [self.frame_field[c.key] for c in per_tile], areas
+        )
+        blits = []
+        start = 0
+        n = 0
+        for chunk in visible:
+            while n < len(actors) and actors[n][0] < chunk.key:
+                surf.blits(blits, False)
+                blits = []
+                actors[n][-1].draw(surf)
+                n += 1
+            if chunk.key in baked:
+                if chunk.surface is None:
+                    self.bake_chunk(chunk, areas, baked)
+                self.baked.move_to_end(chunk.key)
+                x, y = chunk.surface_pos
+                at = (int(self.orig.x) + x, int(self.orig.y) + y)
+                blits.append((chunk.surface, at))
+                continue
+            if chunk.key not in static:
+                self.unbake(chunk.key)
+            chunk_tiles = tiles[start : start + len(chunk)]
+            start += len(chunk)
+            done = 0
+            while n < len(actors) and actors[n][0] == chunk.key:
+                slot = chunk.depth_slot(actors[n][1])
+                blits.extend(chunk_tiles[done:slot])
+                done = max(done, slot)
+                surf.blits(blits, False)
+                blits = []
+                actors[n][-1].draw(surf)
+                n += 1
+            blits.extend(chunk_tiles[done:])
+        surf.blits(blits, False)
+        for actor in actors[n:]:
+            actor[-1].draw(surf)
+
+    def depth_sort(self, actors):
+        # (chunk key, tile, actor) in drawing order, actors on the same tile keep
+        # their order
+        placed = []
+        for actor in actors:
+            tile = (floor(actor.tile[0]), floor(actor.tile[1]))
+            placed.append((chunk_key(tile), tile, actor))
+        placed.sort(key=lambda a: a[:2])
+        return placed
+
+    def bake_plan(self, chunks: list[TileChunk]) -> set[tuple[int, int]]:
+        # Keys of the static chunks to draw from their baked surface this frame.
+        # Together they fit into BAKE_BUDGET, so baking one never evicts another
+        _, _, s_w, s_h = self.projection()
+        # Size of the surface of a full chunk
+        nbytes = 4 * s_w * CHUNK_SIZE * (s_h * (CHUNK_SIZE - 1) // 2 + s_h)
+        if nbytes > self.BAKE_CHUNK_BYTES:
+            return set()
+        plan = {c.key for c in chunks if c.key in self.baked}
+        used = sum(self.baked[key] for key in plan)
+        for c in chunks:
+            if c.key not in plan and used + nbytes <= self.BAKE_BUDGET:
+                plan.add(c.key)
+                used += nbytes
+        return plan
+
+    def is_static_chunk(self, chunk: TileChunk) -> bool:
+        # Static chunks hold no animated sprites and are not reached by any effect
+        return (
+            not self.is_animated_chunk(chunk)
+            and chunk.key not in self.effect_index
+            and not self.unbounded_effects
+        )
+
+    def is_animated_chunk(self, chunk: TileChunk) -> bool:
+        if chunk.static is None:
+            chunk.static = not any(
+                self.sprites.is_animated(t)
+                for t in np.unique(chunk.types).tolist()
+                if t != EMPTY
+            )
+        return not chunk.static
+
+    def fill_field(self, chunks: list[TileChunk]):
+        missing = [c for c in chunks if c.key not in self.frame_field]
+        for c, offsets in zip(missing, self.offset_field(missing)):
+            self.frame_field[c.key] = offsets
+
+    def use_pool(self, pool: None | Executor, size=1):
+        # Split offset evaluation over the size workers of pool. NumPy releases
+        # the GIL in its loops, so threads evaluate their strips in parallel
+        # while sharing the coordinate and offset arrays. Gathering the tiles of
+        # the chunks stays on the calling thread
+        self.pool = pool
+        self.pool_size = size if pool is not None else 1
+
+    def offset_field(self, chunks: list[TileChunk]) -> list[np.ndarray]:
+        # Offsets of all tiles in the chunks in draw order, one batch call per effect
+        # and strip of chunks
+        if not chunks:
+            return []
+        coords = np.concatenate([c.coord_array() for c in chunks])
+        field = np.concatenate([c.offset_array() for c in chunks])
+        starts = np.cumsum([0, *map(len, chunks)]).tolist()
+        unbounded = list(self.unbounded_effects)
+        strips = min(self.pool_size, len(field) // self.STRIP_TILES)
+        reached = any(c.key in self.effect_index for c in chunks)
+        if strips > 1 and (unbounded or reached):
+            # Strips are cut between chunks. Each sees the effects in the same order
+            # as the serial path, so every tile sums up its offsets exactly the
+            # same way
+            cuts = np.searchsorted(starts, np.linspace(0, len(field), strips + 1))
+            cuts = [0, *cuts[1:-1].tolist(), len(chunks)]
+            done = [
+                self.pool.submit(
+                    add_offsets,
+                    coords[starts[a] : starts[b]],
+                    field[starts[a] : starts[b]],
+                    unbounded,
+                    self.effect_reach(chunks[a:b]),
+                )
+                for a, b in zip(cuts, cuts[1:])
+                if a < b
+            ]
+            for d in done:
+                d.result()
+        else:
+            add_offsets(coords, field, unbounded, self.effect_reach(chunks))
+        return np.split(field, starts[1:-1])
+
+    def effect_reach(self, chunks, sizes=None) -> dict[TileAnimation, np.ndarray]:
+        # The bounded effects reaching any of the chunks, each with the indices of
+        # the tiles of the chunks it reaches once the tiles of all chunks are
+        # concatenated. With sizes, chunks are keys with that many tiles each
+        if sizes is None:
+            chunks, sizes = [c.key for c in chunks], map(len, chunks)
+        reach: dict[TileAnimation, list[np.ndarray]] = {}
+        start = 0
+        for key, size in zip(chunks, sizes):
+            for a in self.effect_index.get(key, ()):
+                reach.setdefault(a, []).append(np.arange(start, start + size))
+            start += size
+        return {a: np.concatenate(r) for a, r in reach.items()}
+
+    def tile_blits(self, chunks: list[TileChunk], offsets, areas):
+        # (atlas, position, area) of each tile of the chunks in draw order
+        if not chunks:
+            return []
+        coords = np.concatenate([c.coord_array() for c in chunks])
+        screen = self.iso_to_screen_array(coords, np.concatenate(offsets))
+        # Round down like the baked chunks do, so both line up exactly
+        pos = np.floor(screen).astype(int).tolist()
+        types = np.concatenate([c.type_array() for c in chunks]).astype(int)
+        flipped = np.concatenate([c.flipped_array() for c in chunks])
+        slots = (2 * types + flipped).tolist()
+        atlas = self.sprites.atlas()[0].surface
+        return list(zip(repeat(atlas, len(pos)), pos, map(areas.__getitem__, slots)))
+
+    def bake_chunk(self, chunk: TileChunk, areas: list[pg.Rect], keep=()):
+        # keep holds the keys of chunks that must stay baked, e.g. the visible ones
+        # Placed exactly where drawing the tiles one by one puts them right now
+        placed = self.tile_blits([chunk], [chunk.offset_array()], areas)
+        x0 = min((p[1][0] for p in placed), default=0)
+        y0 = min((p[1][1] for p in placed), default=0)
+        x1 = max((p[1][0] + p[2].width for p in placed), default=0)
+        y1 = max((p[1][1] + p[2].height for p in placed), default=0)
+        srf = pg.Surface((x1 - x0, y1 - y0), pg.SRCALPHA)
+        srf.blits([(a, (x - x0, y - y0), r) for a, (x, y), r in placed], False)
+        chunk.surface = srf
+        chunk.surface_pos = (x0 - int(self.orig.x), y0 - int(self.orig.y))
+        nbytes = srf.get_bytesize() * srf.get_width() * srf.get_height()
+        self.baked[chunk.key] = nbytes
+        self.baked_bytes += nbytes
+        # Evict the chunks that have not been drawn for the longest time
+        if self.baked_bytes > self.BAKE_BUDGET:
+            for key in [k for k in self.baked if k not in keep and k != chunk.key]:
+                self.unbake(key)
+                if self.baked_bytes <= self.BAKE_BUDGET:
+                    break
+
+    def unbake(self, key):
+        if (nbytes := self.baked.pop(key, None)) is not None:
+            self.baked_bytes -= nbytes
+        if chunk := self.chunks.get(key):
+            chunk.surface = None
+
+    def drop_baked(self):
+        for key in list(self.baked):
+            self.unbake(key)
+        self.baked_generation = self.sprites.generation
+
+    def invalidate_tile(self, tile):
+        key = chunk_key(tile)
+        self.unbake(key)
+        self.frame_field.pop(key, None)
+        self.modified.add(key)
+        if self.track_dirty:
+            self.dirty_tiles.add((int(tile[0]), int(tile[1])))
+        if chunk := self.chunks.get(key):
+            chunk.invalidate()
+
+    def take_dirty_rects(self, view: pg.Rect) -> list[pg.Rect]:
+        # Screen rects in the view that may look different than on the last call:
+        # edited tiles, chunks paged in or out, reached by effects now or back
+        # then, or holding animated sprites that have moved to another frame
+        dirty, self.dirty = self.dirty, set()
+        tiles, self.dirty_tiles = self.dirty_tiles, set()
+        # Effects lift tiles by less once they fade, so what they reached is
+        # measured now and repainted with the margins of back then next call
+        reached = self.reached
+        self.reached = [self.chunk_rect(key) for key in self.effect_index]
+        if self.unbounded_effects:
+            return [pg.Rect(view)]
+        keys = dirty | set(self.effect_index)
+        if self.animation_stamp != self.sprites.animation_stamp:
+            self.animation_stamp = self.sprites.animation_stamp
+            keys.update(
+                c.key for c in self.visible_chunks(view) if self.is_animated_chunk(c)
+            )
+        rects = [self.chunk_rect(key) for key in keys]
+        rects += [self.tile_rect(t) for t in tiles if chunk_key(t) not in keys]
+        rects += reached
+        return [r for r in rects if r.colliderect(view)]
+
+    def chunk_lift(self, key) -> float:
+        # How far up or down the tiles of a chunk can be moved by their offsets
+        stored = chunk.lift if (chunk := self.chunks.get(key)) else 0.0
+        return stored + self.effect_lift.get(key, 0.0) + self.unbounded_lift
+
+    def max_lift(self) -> float:
+        # chunk_lift of all chunks at once
+        return self.stored_lift + self.max_effect_lift + self.unbounded_lift
+
+    def chunk_extent(self, key):
+        # Screen box (x0, y0, x1, y1) the tiles of a chunk can cover, with room
+        # for their offsets
+        i0, j0 = key[0] * CHUNK_SIZE, key[1] * CHUNK_SIZE
+        i1, j1 = i0 + CHUNK_SIZE - 1, j0 + CHUNK_SIZE - 1
+        return self.tiles_extent(i0, j0, i1, j1, self.chunk_lift(key))
+
+    def tiles_extent(self, i0, j0, i1, j1, lift):
+        # Screen box of the tiles in the inclusive range, moved up or down by up
+        # to lift tile offsets
+        o_x, o_y, s_w, s_h = self.projection()
+        margin = 0.25 * s_h * lift
+        x0 = o_x + s_w / 2 * (i0 - j1 - 1)
+        x1 = o_x + s_w / 2 * (i1 - j0 + 1)
+        y0 = o_y + 0.25 * s_h * (i0 + j0)
+        y1 = o_y + 0.25 * s_h * (i1 + j1) + s_h
+        return x0, y0 - margin, x1, y1 + margin
+
+    def chunk_rect(self, key) -> pg.Rect:
+        return self.extent_rect(*self.chunk_extent(key))
+
+    def tile_rect(self, tile) -> pg.Rect:
+        lift = self.chunk_lift(chunk_key(tile))
+        return self.extent_rect(*self.tiles_extent(*tile, *tile, lift))
+
+    @staticmethod
+    def extent_rect(x0, y0, x1, y1) -> pg.Rect:
+        return pg.Rect(floor(x0), floor(y0), ceil(x1) - floor(x0), ceil(y1) - floor(y0))
+
+    def visible_chunks(self, view: pg.Rect):
+        # Chunks overlapping the view, in back to front order
+        _, _, s_w, s_h = self.projection()
+        if s_w == 0 or s_h == 0:
+            return []
+        margin = 0.25 * s_h * self.max_lift()
+        # A tile is drawn below and to the right of its anchor point
+        left, right = view.left - s_w, view.right
+        top, bottom = view.top - s_h - margin, view.bottom + margin
+        corners = self.screen_to_iso_array(
+            np.array([(left, top), (left, bottom), (right, top), (right, bottom)])
+        )
+        ci0, cj0 = chunk_key(corners.min(axis=0).tolist())
+        ci1, cj1 = chunk_key(corners.max(axis=0).tolist())
+        if (ci1 - ci0 + 1) * (cj1 - cj0 + 1) > len(self.chunks):
+            keys = sorted(
+                k
+                for k in self.chunks
+                if ci0 <= k[0] <= ci1 and cj0 <= k[1] <= cj1
+            )
+        else:
+            keys = [
+                (ci, cj)
+                for ci in range(ci0, ci1 + 1)
+                for cj in range(cj0, cj1 + 1)
+                if (ci, cj) in self.chunks
+            ]
+        visible = []
+        for k in keys:
+            # The corner checks above select the isometric bounding box of the view,
+            # drop the chunks that fall in its corners but not in the view itself
+            x0, y0, x1, y1 = self.chunk_extent(k)
+            if (
+                x1 >= view.left
+                and x0 <= view.right
+                and y1 >= view.top
+                and y0 <= view.bottom
+            ):
+                visible.append(self.chunks[k])
+        return visible
 
     def draw_block_at(self, surf, pos, block_type, flipped=False, trans=False):
         if sprite := self.sprites.get(block_type, flipped, trans):
@@ -70,149 +486,322 @@ class IsoTiles:
         else:
             return self.sprites[type]
 
+    def get_chunk(self, tile) -> None | TileChunk:
+        return self.chunks.get(chunk_key(tile))
+
     def add_tile(self, idx, type, flipped):
-        self.tile_type[idx] = type
-        if flipped:
-            self.flipped.add(idx)
-        else:
-            try:
-                self.flipped.remove(idx)
-            except KeyError:
-                pass
+        key = chunk_key(idx)
+        if key not in self.chunks:
+            self.chunks[key] = TileChunk(key)
+        self.chunks[key].set(idx, type, flipped)
+        self.invalidate_tile(idx)
+        self.journal_tile(idx)
 
     def remove_tile(self, idx):
-        try:
-            del self.tile_type[idx]
-        except KeyError:
-            pass
+        if not self.is_valid_tile(idx):
+            return
+        key = chunk_key(idx)
+        chunk = self.chunks[key]
+        chunk.clear(idx)
+        self.invalidate_tile(idx)
+        if not chunk:
+            del self.chunks[key]
+        self.journal_tile(idx)
+
+    def journal_tile(self, tile):
+        if self.journal is None:
+            return
+        if (ttype := self.get_tile_type(tile)) is None:
+            self.journal.record(tile, EMPTY, 0)
+        else:
+            chunk = self.get_chunk(tile)
+            self.journal.record(tile, ttype, int(chunk.flags[chunk.local(tile)]))
 
     def get_tile_type(self, tileindex) -> None | int:
-        return self.tile_type.get(tileindex, None)
+        if chunk := self.get_chunk(tileindex):
+            return chunk.get(tileindex)
+        return None
 
     def get_tile_sprite(self, tile) -> None | pg.Surface:
         if not self.is_valid_tile(tile):
             return None
         else:
-            idx = self.tile_type[tile]
-        return self.sprites.get(idx, tile in self.flipped)
+            chunk = self.get_chunk(tile)
+            cell = chunk.local(tile)
+        return self.sprites.get(
+            int(chunk.types[cell]), bool(chunk.flags[cell] & FLIPPED)
+        )
 
     def tile_to_screen(self, tile):
         return self.iso_to_screen(tile, self.get_tile_offset(tile))
 
     def iso_to_screen(self, t, offset=0.0):
-        s_w = self.sprites[0].get_width()
-        s_h = self.sprites[0].get_height()
+        o_x, o_y, s_w, s_h = self.projection()
         i, j = t[0], t[1]
         return Vec2(
-            self.orig.x + s_w / 2 * (i - j - 1),
-            self.orig.y + 0.25 * s_h * (i + j + offset),
+            o_x + s_w / 2 * (i - j - 1),
+            o_y + 0.25 * s_h * (i + j + offset),
         )
 
+    def iso_to_screen_array(self, coords: np.ndarray, offsets=0.0) -> np.ndarray:
+        # iso_to_screen for an (N, 2) array of tiles, returns (N, 2) positions
+        o_x, o_y, s_w, s_h = self.projection()
+        i, j = coords[:, 0], coords[:, 1]
+        screen = np.empty((len(coords), 2))
+        x, y = screen[:, 0], screen[:, 1]
+        np.subtract(i, j, out=x)
+        x -= 1
+        x *= s_w / 2
+        x += o_x
+        np.add(i, j, out=y)
+        y += offsets
+        y *= 0.25 * s_h
+        y += o_y
+        return screen
+
     def screen_to_iso(self, v: Vec2):
-        s_w = self.sprites[0].get_width()
-        s_h = self.sprites[0].get_height()
-        h1 = (v.x - self.orig.x) * 2 / s_w
-        h2 = 4 / s_h * (v.y - self.orig.y)
+        o_x, o_y, s_w, s_h = self.projection()
+        h1 = (v[0] - o_x) * 2 / s_w
+        h2 = 4 / s_h * (v[1] - o_y)
         i = floor((h1 + h2) / 2)
         j = floor((h2 - h1) / 2)
         return (i, j)
 
+    def screen_to_iso_array(self, points: np.ndarray) -> np.ndarray:
+        # screen_to_iso for an (N, 2) array of positions, returns (N, 2) tiles
+        o_x, o_y, s_w, s_h = self.projection()
+        h1 = (points[:, 0] - o_x) * 2 / s_w
+        h2 = 4 / s_h * (points[:, 1] - o_y)
+        tiles = np.empty((len(points), 2), np.int64)
+        tiles[:, 0] = np.floor((h1 + h2) / 2)
+        tiles[:, 1] = np.floor((h2 - h1) / 2)
+        return tiles
+
     def is_valid_tile(self, tile):
-        return tile in self.tile_type
+        return self.get_tile_type(tile) is not None
 
     def get_tile_offset(self, tile) -> float:
+        # Served from the offsets of the current frame, see update. Tiles out of
+        # reach of all effects simply keep their stored offset
+        tile = (tile[0], tile[1])
+        key = chunk_key(tile)
+        chunk = self.chunks.get(key)
+        if key not in self.effect_index and not self.unbounded_effects:
+            return chunk.get_offset(tile) if chunk else 0.0
+        if chunk and (n := chunk.slot_of(tile)) is not None:
+            self.fill_field([chunk])
+            return float(self.frame_field[key][n])
+        if (offset := self.frame_memo.get(tile)) is None:
+            offset = self.frame_memo[tile] = self.eval_tile_offset(tile)
+        return offset
+
+    def get_tile_offsets(self, tiles: np.ndarray) -> np.ndarray:
+        # get_tile_offset for an (N, 2) int array of tiles. Tiles on the grid are
+        # looked up chunk by chunk, the others evaluated in one go
+        offsets = np.zeros(len(tiles))
+        if not len(tiles):
+            return offsets
+        keys = tiles // CHUNK_SIZE
+        cells = (tiles[:, 0] % CHUNK_SIZE) * CHUNK_SIZE + tiles[:, 1] % CHUNK_SIZE
+        _, firsts, group = np.unique(
+            tile_keys(keys), return_index=True, return_inverse=True
+        )
+        order = np.argsort(group, kind="stable")
+        bounds = np.searchsorted(group[order], np.arange(len(firsts) + 1))
+        unbounded = self.unbounded_effects
+        # Tiles not on the grid, by the chunk they fall into
+        off_grid: list[tuple[tuple[int, int], np.ndarray]] = []
+        groups = zip(map(tuple, keys[firsts].tolist()), bounds[:-1], bounds[1:])
+        for key, start, end in groups:
+            sel = order[start:end]
+            chunk = self.chunks.get(key)
+            if key not in self.effect_index and not unbounded:
+                # Out of reach of all effects, tiles keep their stored offset
+                if chunk is not None and chunk.offsets is not None:
+                    offsets[sel] = chunk.offsets.ravel()[cells[sel]]
+                continue
+            if chunk is not None and len(chunk):
+                self.fill_field([chunk])
+                cell_order = chunk.cell_order()
+                slots = np.minimum(
+                    np.searchsorted(cell_order, cells[sel]), len(cell_order) - 1
+                )
+                on_grid = cell_order[slots] == cells[sel]
+                offsets[sel[on_grid]] = self.frame_field[key][slots[on_grid]]
+                sel = sel[~on_grid]
+            if len(sel):
+                off_grid.append((key, sel))
+        if off_grid:
+            missing = np.concatenate([sel for _, sel in off_grid])
+            reach = self.effect_reach(
+                [key for key, _ in off_grid], [len(sel) for _, sel in off_grid]
+            )
+            field = np.zeros(len(missing))
+            add_offsets(
+                tiles[missing].astype(float), field, unbounded, reach
+            )
+            offsets[missing] = field
+        return offsets
+
+    def eval_tile_offset(self, tile) -> float:
         # if not self.is_valid_tile(tile):
         #     return 0.0
         # else:
-        offset = self.tile_offsets.get(tile, 0.0)
-        for a in self.animations:
+        offset = 0.0
+        for a in self.effect_index.get(chunk_key(tile), ()):
+            offset += a.get_offset(tile)
+        for a in self.unbounded_effects:
             offset += a.get_offset(tile)
         return offset
 
     def set_tile_offset(self, tile, offset):
         if self.is_valid_tile(tile):
-            self.tile_offsets[tile] = offset
+            chunk = self.get_chunk(tile)
+            chunk.set_offset(tile, offset)
+            self.stored_lift = max(self.stored_lift, chunk.lift)
+            self.invalidate_tile(tile)
 
     def set_tile_type(self, tile, ttype=0):
         if self.is_valid_tile(tile):
-            self.tile_type[tile] = ttype
+            chunk = self.get_chunk(tile)
+            chunk.types[chunk.local(tile)] = ttype
+            self.invalidate_tile(tile)
+            self.journal_tile(tile)
 
     def flip_tile(self, tile):
         if self.is_valid_tile(tile):
-            if tile in self.flipped:
-                self.flipped.remove(tile)
-            else:
-                self.flipped.add(tile)
-
-    def update(self):
-        self.animations.update()
+            chunk = self.get_chunk(tile)
+            chunk.flags[chunk.local(tile)] ^= FLIPPED
+            self.invalidate_tile(tile)
+            self.journal_tile(tile)
+
+    def update(self, dt=1 / 60):
+        # Advance the effects by dt seconds. The offsets of the new state are
+        # computed when they are first needed, at most once per drawn frame
+        self.animations.update(dt)
+        self.index_effects()
+        self.frame_field = {}
+        self.frame_memo = {}
+
+    def index_effects(self):
+        self.effect_index = {}
+        self.effect_lift = {}
+        self.unbounded_effects = []
+        self.unbounded_lift = 0.0
+        for a in self.animations:
+            if (b := a.get_bounds()) is None:
+                self.unbounded_effects.append(a)
+                self.unbounded_lift += a.get_amplitude()
+                continue
+            ci0, cj0 = chunk_key((floor(b[0]), floor(b[1])))
+            ci1, cj1 = chunk_key((floor(b[2]), floor(b[3])))
+            for ci in range(ci0, ci1 + 1):
+                for cj in range(cj0, cj1 + 1):
+                    i0 = ci * CHUNK_SIZE
+                    j0 = cj * CHUNK_SIZE
+                    if a.reaches(i0, j0, i0 + CHUNK_SIZE - 1, j0 + CHUNK_SIZE - 1):
+                        self.effect_index.setdefault((ci, cj), []).append(a)
+                        lift = self.effect_lift.get((ci, cj), 0.0) + a.get_amplitude()
+                        self.effect_lift[(ci, cj)] = lift
+        self.max_effect_lift = max(self.effect_lift.values(), default=0.0)
+
+
+def add_offsets(coords, field, unbounded, reach):
+    # Adds the offsets of the effects at the (N, 2) tile coords to field. reach
+    # maps the bounded effects to the indices of the tiles they may reach, see
+    # IsoTiles.effect_reach, of which only the ones inside their bounds are
+    # evaluated
+    for a in unbounded:
+        field += a.get_offsets(coords)
+    for a, sel in reach.items():
+        i0, j0, i1, j1 = a.get_bounds()
+        i, j = coords[sel, 0], coords[sel, 1]
+        sel = sel[(i >= i0) & (i <= i1) & (j >= j0) & (j <= j1)]
+        if len(sel):
+            field[sel] += a.get_offsets(coords[sel])
 
 
 class Bar:
-    def __init__(
-        self, dim, ratio=0.0, bg=pg.Color(60, 60, 60), fg=pg.Color(0, 200, 60)
-    ):
-        # 0 Empty 1 Full
-        self.ratio = ratio
+    # Look of a bar, one is shared by everything showing the same kind of bar
+    __slots__ = ("dim", "bg", "fg")
+
+    def __init__(self, dim, bg=pg.Color(60, 60, 60), fg=pg.Color(0, 200, 60)):
         self.dim = dim
         self.bg = bg
         self.fg = fg
 
-    def set_ratio(self, ratio):
-        self.ratio = ratio
+    def rect(self, at):
+        return pg.Rect(at, self.dim)
 
-    def draw(self, surf, at):
+    def draw(self, surf, at, ratio):
+        # ratio 0 is empty, 1 full
         back = pg.Rect(at, self.dim)
-        front = pg.Rect(at, (self.dim.x * self.ratio, self.dim.y))
+        front = pg.Rect(at, (self.dim.x * ratio, self.dim.y))
         pg.draw.rect(surf, self.bg, back)
         pg.draw.rect(surf, self.fg, front)
 
 
-class Building(pg.sprite.Sprite):
+def spawn_building(world: World, coord) -> int:
+    return world.spawn(
+        BUILDING_COMPONENTS,
+        pos=coord,
+        hp=BuildingRenderer.MAX_HP,
+        max_hp=BuildingRenderer.MAX_HP,
+        kind=BUILDING,
+    )
+
+
+class BuildingRenderer:
+    # Draws buildings with their health bar, lifted along with their tile
     MAX_HP = 100
+    HP_BAR = Bar(Vec2(40, 10))
 
-    def __init__(self, sp_cat, iso_tiles, where=(0, 0)):
-        super().__init__()
-        self.coord = where
+    def __init__(self, sp_cat, tiles):
         self.catalogue = sp_cat
-        self.iso_tiles = iso_tiles
-        self.building_hp = self.MAX_HP
-        self.bar = Bar(Vec2(40, 10), ratio=self.building_hp / self.MAX_HP)
+        self.tiles = tiles
 
-    def draw(self, srf, trans=False):
-        pos = self.iso_tiles.iso_to_screen(
-            self.coord, offset=-0.4 + self.iso_tiles.get_tile_offset(self.coord)
-        )
+    def placement(self, coord, lift, trans=False):
+        pos = self.tiles.iso_to_screen(coord, offset=-0.4 + lift)
         img = self.catalogue.get(0, trans=trans)
         dst = img.get_rect()
         # Extremely hacky, but places the image at the roughly correct location
         dst.x = int(pos.x + 0.1 * dst.width)
         dst.y = int(pos.y + 0.1 * dst.height)
-        srf.blit(img, dst)
-        self.bar.draw(srf, pos)
-
-    def check_collisions(self, proj_grp):
-        for p in proj_grp.copy():
-            # Snap to tile coord
-            tile = (floor(p.coord.x), floor(p.coord.y)+1)
-            print(f"Tile {tile} City {self.coord}")
-            if tile == self.coord:
-                p.kill()
-                self.damage(20)
-
-    def update(self, proj_grp):
-        self.check_collisions(proj_grp)
-
-    def damage(self, dmg):
-        self.building_hp -= dmg
-        self.bar.set_ratio(self.building_hp / self.MAX_HP)
-        if self.building_hp <= 0:
-            self.explode()
-
-    def explode(self):
-        effect = CircularWaveAnimation(
-            amplitude=1, ahead=1, trail=1, epicenter=self.coord
-        )
-        self.iso_tiles.animations.add(effect)
-        self.kill()
+        return pos, img, dst
 
+    def draw(self, srf, coord, lift, ratio=1.0, trans=False):
+        pos, img, dst = self.placement(coord, lift, trans)
+        srf.blit(img, dst)
+        self.HP_BAR.draw(srf, pos, ratio)
+
+    def screen_state(self, coord, lift, hp, trans=False):
+        # Screen rect and whatever else decides what the building looks like
+        pos, img, dst = self.placement(coord, lift, trans)
+        return dst.union(self.HP_BAR.rect(pos)), hp, trans
+
+    def extent(self):
+        # Buildings are lifted along with their tile, at most as far as any tile
+        w, h = self.catalogue.get(0).get_size()
+        s_h = self.tiles.projection()[3]
+        lift = 0.25 * s_h * (0.4 + self.tiles.max_lift())
+        bar_w, bar_h = self.HP_BAR.dim
+        return (0, -lift, max(1.1 * w, bar_w) + 1, max(1.1 * h, bar_h) + 1 + lift)
+
+    def actors(self, world: World, rows) -> list[Drawable]:
+        tiles = world.tiles_of(rows).tolist()
+        coords = world.pos[rows].tolist()
+        lifts = world.lift[rows].tolist()
+        ratios = (world.hp[rows] / world.max_hp[rows]).tolist()
+        return [
+            Drawable(tuple(tile), self.draw, coord, lift, ratio)
+            for tile, coord, lift, ratio in zip(tiles, coords, lifts, ratios)
+        ]
+
+    def screen_states(self, world: World, rows) -> dict:
+        coords = world.pos[rows].tolist()
+        lifts = world.lift[rows].tolist()
+        hps = world.hp[rows].tolist()
+        return {
+            ("building", row): self.screen_state(coord, lift, hp)
+            for row, coord, lift, hp in zip(rows.tolist(), coords, lifts, hps)
+        }
@@ -0,0 +1,167 @@
+import os
+import struct
+import threading
+import numpy as np
+from chunks import CHUNK_SIZE, FLIPPED, TileChunk, fill_chunks
+from worldio import WorldFile, write_world
+
+# Journal file layout: MAGIC followed by fixed size records holding the new
+# state of one cell, tile (i, j), type (EMPTY once removed) and flags.
+# Replaying the records in order on top of the snapshot restores the world
+MAGIC = b"ISOJ"
+RECORD = struct.Struct("<iihB")
+RECORD_DTYPE = np.dtype(
+    [("tile", "<i4", (2,)), ("type", "<i2"), ("flags", "u1")], align=False
+)
+
+
+def journal_name(snapshot):
+    return f"{snapshot}.journal"
+
+
+def journal_files(snapshot):
+    # Journals to replay on top of the snapshot, oldest first
+    return f"{journal_name(snapshot)}.old", journal_name(snapshot)
+
+
+def open_journal(filename):
+    # Open for appending, dropping a record cut short by a crash first
+    jfile = open(filename, "ab")
+    size = jfile.tell()
+    if size < len(MAGIC):
+        jfile.truncate(0)
+        jfile.write(MAGIC)
+    elif (size - len(MAGIC)) % RECORD.size:
+        jfile.truncate(size - (size - len(MAGIC)) % RECORD.size)
+        jfile.seek(0, os.SEEK_END)
+    return jfile
+
+
+class TileEdits:
+    # Records read back from journals, grouped by the chunk they touch
+    def __init__(self, records: np.ndarray):
+        self.records = records
+        self.groups: dict[tuple[int, int], list[int]] = {}
+        for n, (i, j) in enumerate(records["tile"].tolist()):
+            self.groups.setdefault((i // CHUNK_SIZE, j // CHUNK_SIZE), []).append(n)
+
+    @classmethod
+    def read(cls, *filenames):
+        parts = []
+        for filename in filenames:
+            if not os.path.exists(filename):
+                continue
+            with open(filename, "rb") as jfile:
+                data = jfile.read()
+            if data[: len(MAGIC)] != MAGIC:
+                raise ValueError(f"{filename} is not a journal")
+            # A crash may have cut the last record short, skip it
+            count = (len(data) - len(MAGIC)) // RECORD.size
+            parts.append(np.frombuffer(data, RECORD_DTYPE, count, len(MAGIC)))
+        return cls(np.concatenate(parts) if parts else np.zeros(0, RECORD_DTYPE))
+
+    def __len__(self):
+        return len(self.records)
+
+    def keys(self):
+        return list(self.groups)
+
+    def apply(self, chunk: TileChunk) -> TileChunk:
+        if rows := self.groups.get(chunk.key):
+            r = self.records[rows]
+            fill_chunks(
+                {chunk.key: chunk}, r["tile"], r["type"], (r["flags"] & FLIPPED) != 0
+            )
+        return chunk
+
+
+def compact_journal(snapshot, journal):
+    # Fold the journal into the snapshot, one chunk at a time
+    edits = TileEdits.read(journal)
+    world = WorldFile(snapshot) if os.path.exists(snapshot) else None
+
+    def chunks():
+        stored = world.keys() if world else []
+        for key in stored:
+            yield edits.apply(world.read_chunk(key))
+        for key in edits.keys():
+            if not world or key not in world:
+                yield edits.apply(TileChunk(key))
+
+    try:
+        write_world(snapshot, chunks())
+    finally:
+        if world:
+            world.close()
+    os.remove(journal)
+
+
+class EditJournal:
+    # Append only log of tile edits made since the last full snapshot. Saving only
+    # has to flush the records, and compaction folds them into the snapshot on a
+    # background thread
+    def __init__(self, snapshot, truncate=False):
+        self.snapshot = snapshot
+        self.old_filename, self.filename = journal_files(snapshot)
+        if truncate:
+            # A new snapshot has been written, earlier edits are part of it
+            for name in (self.filename, self.old_filename):
+                if os.path.exists(name):
+                    os.remove(name)
+        self.file = open_journal(self.filename)
+        self.pending: list[bytes] = []
+        self.count = (self.file.tell() - len(MAGIC)) // RECORD.size
+        self.compactor: None | threading.Thread = None
+
+    def record(self, tile, ttype, flags):
+        self.pending.append(RECORD.pack(int(tile[0]), int(tile[1]), ttype, flags))
+        self.count += 1
+
+    def record_many(self, coords, types, flags):
+        records = np.zeros(len(coords), RECORD_DTYPE)
+        records["tile"] = coords
+        records["type"] = types
+        records["flags"] = flags
+        self.pending.append(records.tobytes())
+        self.count += len(records)
+
+    def flush(self, sync=False):
+        if self.pending:
+            self.file.write(b"".join(self.pending))
+            self.pending = []
+        self.file.flush()
+        if sync:
+            os.fsync(self.file.fileno())
+
+    def compacting(self):
+        return self.compactor is not None and self.compactor.is_alive()
+
+    def compact(self):
+        if self.compacting():
+            return
+        self.flush()
+        self.file.close()
+        # Move the records aside and keep logging to a fresh journal. A leftover
+        # from an interrupted compaction gets folded in by this one
+        if os.path.exists(self.old_filename):
+            with open(self.filename, "rb") as jfile:
+                data = jfile.read()[len(MAGIC) :]
+            with open_journal(self.old_filename) as old:
+                old.write(data)
+            os.remove(self.filename)
+        else:
+            os.replace(self.filename, self.old_filename)
+        self.file = open_journal(self.filename)
+        self.count = 0
+        self.compactor = threading.Thread(
+            target=compact_journal,
+            args=(self.snapshot, self.old_filename),
+            daemon=True,
+        )
+        self.compactor.start()
+
+    def close(self):
+        self.flush(sync=True)
+        self.file.close()
+        if self.compactor is not None:
+            self.compactor.join()
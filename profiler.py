@@ -0,0 +1,85 @@
+import csv
+import time
+from collections import deque
+from contextlib import nullcontext
+import numpy as np
+
+# Handed out while profiling is off, entering it costs next to nothing
+NO_SECTION = nullcontext()
+
+
+class Section:
+    # Adds the time spent inside the with block to the phase's total of the frame
+    __slots__ = ("totals", "name", "start")
+
+    def __init__(self, totals, name):
+        self.totals = totals
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc):
+        self.totals[self.name] += time.perf_counter() - self.start
+
+
+class FrameProfiler:
+    # Per frame timings of the phases of a frame, e.g.
+    #   with profiler.section("tiles"):
+    #       tiles.draw(surf)
+    # followed by end_frame once the frame is done. A phase may run several times
+    # a frame, its times are summed. The last history frames are kept for the
+    # overlay, and all of them can be streamed to a CSV file in milliseconds
+    def __init__(self, phases, history=120):
+        self.phases = phases
+        self.visible = False
+        self.enabled = False
+        self.totals = dict.fromkeys(phases, 0.0)
+        self.samples = {p: deque(maxlen=history) for p in phases}
+        self.frames = 0
+        self.file = None
+        self.writer = None
+
+    def stream_to(self, filename):
+        self.file = open(filename, "w", newline="")
+        self.writer = csv.writer(self.file)
+        self.writer.writerow(["frame", *self.phases])
+        self.enabled = True
+
+    def toggle(self):
+        # Show or hide the overlay, samples are only taken while they are needed
+        self.visible = not self.visible
+        self.enabled = self.visible or self.writer is not None
+
+    def section(self, name):
+        if not self.enabled:
+            return NO_SECTION
+        return Section(self.totals, name)
+
+    def end_frame(self):
+        if not self.enabled:
+            return
+        for phase, total in self.totals.items():
+            self.samples[phase].append(total)
+        if self.writer:
+            self.writer.writerow(
+                [self.frames, *(f"{t * 1000:.3f}" for t in self.totals.values())]
+            )
+        self.frames += 1
+        self.totals = dict.fromkeys(self.phases, 0.0)
+
+    def report(self) -> str:
+        # Rolling average and 99th percentile of each phase, one line each
+        lines = [f"{'phase':<12}{'avg ms':>8}{'p99 ms':>8}"]
+        for phase, samples in self.samples.items():
+            if samples:
+                ms = np.fromiter(samples, float, len(samples)) * 1000
+                avg, p99 = ms.mean(), np.percentile(ms, 99)
+                lines.append(f"{phase:<12}{avg:>8.2f}{p99:>8.2f}")
+        return "\n".join(lines)
+
+    def close(self):
+        if self.file:
+            self.file.close()
+            self.file = None
+            self.writer = None
@@ -0,0 +1,91 @@
+from math import ceil
+import numpy as np
+import pygame as pg
+from ecs import (
+    COLLIDER,
+    POSITION,
+    PROJECTILE,
+    RENDERABLE,
+    SCREEN_BOUND,
+    VELOCITY,
+    Drawable,
+    World,
+)
+
+# Tiles per second
+PROJECTILE_SPEED = 1.0
+PROJECTILE_COLOR = (200, 0, 0)
+PROJECTILE_DAMAGE = 20
+# Radius in pixels at zoom 1
+PROJECTILE_SIZE = 10
+PROJECTILE_COMPONENTS = POSITION | VELOCITY | RENDERABLE | COLLIDER | SCREEN_BOUND
+
+
+def spawn_projectile(world: World, direction, coord) -> int:
+    return world.spawn(
+        PROJECTILE_COMPONENTS,
+        pos=coord,
+        anchor=(0, 1),
+        vel=(PROJECTILE_SPEED * direction[0], PROJECTILE_SPEED * direction[1]),
+        kind=PROJECTILE,
+        damage=PROJECTILE_DAMAGE,
+    )
+
+
+def blit_all(surf, blits):
+    surf.blits(blits, False)
+
+
+class ProjectileRenderer:
+    # Draws projectiles as stamps of a cached circle, one blits call for all the
+    # projectiles above the same tile
+    def __init__(self, tiles):
+        self.tiles = tiles
+        self.scale = 1.0
+        # Image of a projectile and the radius it has been drawn with
+        self.stamp: tuple[float, pg.Surface] | None = None
+
+    def radius(self):
+        return ceil(self.scale * PROJECTILE_SIZE)
+
+    def stamp_image(self) -> pg.Surface:
+        radius = self.scale * PROJECTILE_SIZE
+        if self.stamp is None or self.stamp[0] != radius:
+            r = self.radius()
+            image = pg.Surface((2 * r + 1, 2 * r + 1))
+            image.set_colorkey((0, 0, 0))
+            pg.draw.circle(image, PROJECTILE_COLOR, (r, r), radius)
+            self.stamp = (radius, image)
+        return self.stamp[1]
+
+    def extent(self):
+        r = self.radius() + 1
+        return (-r, -r, r, r)
+
+    def screen_corners(self, world: World, rows) -> np.ndarray:
+        # Top left corners of the stamps of the rows
+        at = self.tiles.iso_to_screen_array(world.draw_pos[rows])
+        return np.rint(at).astype(np.int64) - self.radius()
+
+    def actors(self, world: World, rows) -> list[Drawable]:
+        image = self.stamp_image()
+        tiles = world.tiles_of(rows)
+        order = np.lexsort((tiles[:, 1], tiles[:, 0]))
+        tiles = tiles[order]
+        corners = self.screen_corners(world, rows[order]).tolist()
+        blits = [(image, at) for at in corners]
+        starts = np.flatnonzero(np.any(np.diff(tiles, axis=0), axis=1)) + 1
+        bounds = [0, *starts.tolist(), len(rows)]
+        firsts = tiles[bounds[:-1]].tolist()
+        return [
+            Drawable(tuple(tile), blit_all, blits[start:end])
+            for tile, start, end in zip(firsts, bounds, bounds[1:])
+        ]
+
+    def screen_states(self, world: World, rows) -> dict:
+        size = 2 * self.radius() + 1
+        corners = self.screen_corners(world, rows).tolist()
+        return {
+            ("projectile", row): (pg.Rect(x, y, size, size),)
+            for row, (x, y) in zip(rows.tolist(), corners)
+        }
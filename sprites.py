@@ -1,10 +1,28 @@
 import os
 import pygame as pg
+from collections import OrderedDict
+
+# Memory available to scaled sprite images of all zoom levels
+SCALE_CACHE_BYTES = 64 * 1024 * 1024
+# Scales are rounded to this many steps per unit, so zooming back and forth
+# lands on the same cached images
+SCALE_STEPS = 100
+# Animation durations given as updatecnt are counted in frames at this rate
+ANIMATION_RATE = 60
+# Memory available to the atlases of each catalogue over all zoom levels, and
+# the most an atlas row is wide
+ATLAS_CACHE_BYTES = 64 * 1024 * 1024
+ATLAS_WIDTH = 2048
+# Order of the variants of a sprite frame in an atlas, by (flipped, trans)
+VARIANTS = ((False, False), (True, False), (False, True), (True, True))
 
 
 def load_image(file):
     try:
-        image = pg.image.load(file).convert_alpha()
+        image = pg.image.load(file)
+        # Without a display (headless runs) images stay in their file's format
+        if pg.display.get_surface() is not None:
+            image = image.convert_alpha()
     except FileNotFoundError:
         print(f"Could not load resource from file {file}")
         errsurf = pg.Surface((20, 20))
@@ -19,6 +37,71 @@ def scale_uniform(img, factor=1.0):
     return simg
 
 
+def surface_bytes(surf: pg.Surface) -> int:
+    return surf.get_bytesize() * surf.get_width() * surf.get_height()
+
+
+def quantize_scale(scale):
+    return round(scale * SCALE_STEPS) / SCALE_STEPS
+
+
+class SurfaceCache:
+    # Least recently used surfaces, evicted once they take more than budget bytes.
+    # size gives the bytes held by a cached value, by default a surface
+    def __init__(self, budget=SCALE_CACHE_BYTES, size=surface_bytes):
+        self.budget = budget
+        self.size = size
+        self.used = 0
+        self.surfaces: OrderedDict[tuple, pg.Surface] = OrderedDict()
+
+    def get(self, key, make):
+        if (surf := self.surfaces.get(key)) is not None:
+            self.surfaces.move_to_end(key)
+            return surf
+        surf = make()
+        self.surfaces[key] = surf
+        self.used += self.size(surf)
+        while self.used > self.budget and len(self.surfaces) > 1:
+            _, old = self.surfaces.popitem(last=False)
+            self.used -= self.size(old)
+        return surf
+
+    def clear(self):
+        self.surfaces.clear()
+        self.used = 0
+
+
+# Scaled images of every sprite, keyed by (raw image, scale, flipped, trans)
+scale_cache = SurfaceCache()
+
+
+class SpriteAtlas:
+    # Images packed into rows of a single surface, so they can be drawn with one
+    # Surface.blits call. areas[n] is the part of surface holding images[n]
+    def __init__(self, images: list[pg.Surface], max_width=ATLAS_WIDTH):
+        self.areas: list[pg.Rect] = []
+        x = y = row_height = 0
+        for img in images:
+            w, h = img.get_size()
+            if x and x + w > max_width:
+                x, y, row_height = 0, y + row_height, 0
+            self.areas.append(pg.Rect(x, y, w, h))
+            x += w
+            row_height = max(row_height, h)
+        width = max((r.right for r in self.areas), default=1)
+        height = max((r.bottom for r in self.areas), default=1)
+        if images:
+            self.surface = pg.Surface((width, height), pg.SRCALPHA, images[0])
+        else:
+            self.surface = pg.Surface((width, height), pg.SRCALPHA)
+        self.surface.fill((0, 0, 0, 0))
+        # Adding to the cleared surface copies the pixels including their alpha
+        self.surface.blits(
+            [(img, r, None, pg.BLEND_RGBA_ADD) for img, r in zip(images, self.areas)],
+            False,
+        )
+
+
 class Cycle:
     def __init__(self, start=0, modulus=2, offset=0):
         self.val = start
@@ -58,23 +141,39 @@ class Sprite(pg.sprite.Sprite):
     def set_scale(self, global_scale=1.0):
         # Global scale of the game
         self.global_scale = global_scale
-        self.scaled = scale_uniform(self.raw, self.size * self.global_scale)
-        self.flipped = pg.transform.flip(self.scaled, flip_x=True, flip_y=False)
-        self.trans = make_trans(self.scaled, 128)
-        self.trans_flipped = pg.transform.flip(self.trans, flip_x=True, flip_y=False)
+        self.scale = quantize_scale(self.size * self.global_scale)
+        # Variants of the current image at the current scale, by (flipped, trans).
+        # They are only made when first asked for
+        self.current: dict[tuple[bool, bool], pg.Surface] = {}
 
     def get(self, flipped=False, trans=False):
-        if not flipped and not trans:
-            return self.scaled
-        elif not flipped and trans:
-            return self.trans
-        elif flipped and not trans:
-            return self.flipped
-        elif flipped and trans:
-            return self.trans_flipped
-
-    def update(self):
-        pass
+        if (img := self.current.get((flipped, trans))) is None:
+            img = self.variant(self.raw, flipped, trans)
+            self.current[(flipped, trans)] = img
+        return img
+
+    def variant(self, image, flipped, trans):
+        key = (image, self.scale, flipped, trans)
+        return scale_cache.get(key, lambda: self.make_variant(image, flipped, trans))
+
+    def images(self):
+        # Every image this sprite can show, and the one it shows now
+        return [self.raw]
+
+    def frame(self):
+        return 0
+
+    def make_variant(self, image, flipped, trans):
+        if flipped:
+            img = self.variant(image, False, trans)
+            return pg.transform.flip(img, flip_x=True, flip_y=False)
+        if trans:
+            return make_trans(self.variant(image, False, False), 128)
+        return scale_uniform(image, self.scale)
+
+    def update(self, dt):
+        # Returns whether the sprite now shows another image
+        return False
 
     @classmethod
     def from_file(cls, filename, global_scale=1.0, size=1.0):
@@ -83,16 +182,39 @@ class Sprite(pg.sprite.Sprite):
 
 class AnimatedSprite(Sprite):
     def __init__(self, images, global_scale=1.0, size=1.0, updatecnt=60):
-        super().__init__(images[0], global_scale, size)
         self.frames = images
         self.cycle = Cycle(0, len(images))
+        # Seconds each frame is shown for
+        self.frame_time = updatecnt / ANIMATION_RATE
+        self.elapsed = 0.0
         self.paused = False
+        super().__init__(images[0], global_scale, size)
 
-    def update(self):
-        if not self.paused:
-            self.cycle.cycle_up()
-            self.raw = self.frames[self.cycle.get()]
-            self.set_scale(self.global_scale)
+    def set_scale(self, global_scale=1.0):
+        super().set_scale(global_scale)
+        # Variants of every frame at the current scale, advancing only switches
+        # between them
+        self.frame_variants = [{} for _ in self.frames]
+        self.current = self.frame_variants[self.cycle.get()]
+
+    def images(self):
+        return self.frames
+
+    def frame(self):
+        return self.cycle.get()
+
+    def update(self, dt):
+        if self.paused:
+            return False
+        self.elapsed += dt
+        if self.elapsed < self.frame_time:
+            return False
+        steps = int(self.elapsed // self.frame_time)
+        self.elapsed -= steps * self.frame_time
+        self.cycle.val = (self.cycle.val + steps) % self.cycle.modulus
+        self.raw = self.frames[self.cycle.get()]
+        self.current = self.frame_variants[self.cycle.get()]
+        return steps % self.cycle.modulus != 0
 
     def pause(self, pause=True):
         self.paused = pause
@@ -110,11 +232,18 @@ class AnimatedSprite(Sprite):
 
 
 class SpriteCatalogue:
-    def __init__(self, updatecnt=120):
-        self.updatecnt = updatecnt
+    def __init__(self):
         self.global_scale = 1.0
-        self.count = 0
         self.sprites: list[Sprite] = []
+        # Bumped whenever the scaled images change, so users can drop derived caches
+        self.generation = 0
+        # Bumped whenever an animated sprite moves on to another frame
+        self.animation_stamp = 0
+        # Atlases of the recently used zoom levels with the position of each
+        # sprite in them, see atlas
+        self.atlases = SurfaceCache(
+            ATLAS_CACHE_BYTES, lambda entry: surface_bytes(entry[0].surface)
+        )
 
     def add_sprites(self, *sprites):
         print(sprites)
@@ -126,18 +255,47 @@ class SpriteCatalogue:
         return range(num_before, num_after)
 
     def scale_catalogue(self, scale=1.0):
+        self.global_scale = scale
+        self.generation += 1
         for s in self.sprites:
             s.set_scale(scale)
 
+    def atlas(self) -> tuple[SpriteAtlas, list[int]]:
+        # The atlas at the current scale, and for each sprite the index of the
+        # area holding its first frame. Frames follow each other, each as the
+        # four VARIANTS
+        key = (quantize_scale(self.global_scale), len(self.sprites))
+        return self.atlases.get(key, self.make_atlas)
+
+    def make_atlas(self) -> tuple[SpriteAtlas, list[int]]:
+        images, starts = [], []
+        for s in self.sprites:
+            starts.append(len(images))
+            for image in s.images():
+                images.extend(s.variant(image, f, t) for f, t in VARIANTS)
+        return SpriteAtlas(images), starts
+
+    def atlas_areas(self, trans=False) -> list[pg.Rect]:
+        # Areas of the atlas showing the current frame of each sprite, indexed by
+        # 2 * sprite index + flipped
+        atlas, starts = self.atlas()
+        areas = []
+        for s, start in zip(self.sprites, starts):
+            n = start + len(VARIANTS) * s.frame() + 2 * trans
+            areas.extend(atlas.areas[n : n + 2])
+        return areas
+
+    def is_animated(self, idx):
+        return isinstance(self.sprites[idx], AnimatedSprite)
+
     def __getitem__(self, idx):
         return self.get(idx)
 
-    def update(self):
-        self.count += 1
-        if self.count >= self.updatecnt:
-            self.count = 0
-            for s in self.sprites:
-                s.update()
+    def update(self, dt):
+        # Advance the animations by dt seconds
+        for s in self.sprites:
+            if s.update(dt):
+                self.animation_stamp += 1
 
     def get(self, idx, flipped=False, trans=False):
         return self.sprites[idx].get(flipped, trans)
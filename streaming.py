@@ -0,0 +1,154 @@
+import threading
+import queue
+import numpy as np
+from chunks import EMPTY, TileChunk, chunk_key
+from isotiles import IsoTiles
+from worldio import WorldFile, write_world
+
+
+def merge_edits(stored: TileChunk, edited: None | TileChunk) -> TileChunk:
+    # Apply the tiles placed in memory on top of the chunk read from disk
+    if edited is None:
+        return stored
+    mask = edited.types != EMPTY
+    stored.types[mask] = edited.types[mask]
+    stored.flags[mask] = edited.flags[mask]
+    if edited.offsets is not None:
+        stored.offsets = edited.offsets.copy()
+        stored.lift = edited.lift
+    stored.recount()
+    return stored
+
+
+class ChunkStreamer:
+    # Pages the chunks of a binary world file into an IsoTiles on a worker thread.
+    # The chunks closest to the camera are read first, and once more than budget
+    # chunks are resident the farthest unedited ones are paged out again.
+    # edits from a journal are applied to the chunks as they are read
+    def __init__(
+        self, tiles: IsoTiles, filename, budget=4096, per_frame=16, edits=None
+    ):
+        self.tiles = tiles
+        self.edits = edits
+        self.budget = budget
+        # Maximum number of chunks handed to the tiles per update
+        self.per_frame = per_frame
+        self.center = None
+        # Chunks of the file that should be resident, nearest to the camera first
+        self.target: list[tuple[int, int]] = []
+        self.target_set: set[tuple[int, int]] = set()
+        # Chunks whose stored version has been handed to the tiles
+        self.resident: set[tuple[int, int]] = set()
+        # Chunks queued for the worker, being read or waiting in self.loaded
+        self.queued: set[tuple[int, int]] = set()
+        # Shared with the worker, guarded by self.lock
+        self.lock = threading.Condition()
+        self.wanted: list[tuple[int, int]] = []
+        self.running = True
+        self.loaded: queue.SimpleQueue[TileChunk] = queue.SimpleQueue()
+        # Held while reading from the world file, and while it is swapped out
+        self.reading = threading.Lock()
+        self.open(filename)
+        self.worker = threading.Thread(target=self.work, daemon=True)
+        self.worker.start()
+
+    def open(self, filename):
+        self.world = WorldFile(filename)
+        self.stored = set(self.world.keys())
+        if self.edits is not None:
+            self.stored.update(self.edits.keys())
+        self.keys = np.array(list(self.stored), dtype=np.int64).reshape(-1, 2)
+
+    def read(self, key) -> TileChunk:
+        chunk = self.world.read_chunk(key) if key in self.world else TileChunk(key)
+        if self.edits is not None:
+            chunk = self.edits.apply(chunk)
+        return chunk
+
+    def work(self):
+        while True:
+            with self.lock:
+                while self.running and not self.wanted:
+                    self.lock.wait()
+                if not self.running:
+                    return
+                key = self.wanted.pop(0)
+            # Reading happens outside of self.lock, so retargeting never waits
+            # for it
+            with self.reading:
+                chunk = self.read(key)
+            self.loaded.put(chunk)
+
+    def update(self, center_tile):
+        key = chunk_key(center_tile)
+        if key != self.center:
+            self.center = key
+            self.retarget()
+        for _ in range(self.per_frame):
+            try:
+                chunk = self.loaded.get_nowait()
+            except queue.Empty:
+                break
+            self.queued.discard(chunk.key)
+            self.install(chunk)
+
+    def retarget(self):
+        d = np.abs(self.keys - np.asarray(self.center)).max(axis=1)
+        if len(d) > self.budget:
+            near = np.argpartition(d, self.budget - 1)[: self.budget]
+        else:
+            near = np.arange(len(d))
+        near = near[np.argsort(d[near], kind="stable")]
+        self.target = [tuple(k) for k in self.keys[near].tolist()]
+        self.target_set = set(self.target)
+        # Page out what fell out of the budget, unless it holds edits
+        for key in list(self.resident - self.target_set):
+            if key not in self.tiles.modified:
+                self.tiles.drop_chunk(key)
+                self.resident.discard(key)
+        with self.lock:
+            # What the worker has taken already arrives through self.loaded
+            taken = self.queued.difference(self.wanted)
+            self.wanted = [
+                k for k in self.target if k not in self.resident and k not in taken
+            ]
+            self.queued = taken.union(self.wanted)
+            self.lock.notify()
+
+    def install(self, chunk: TileChunk):
+        if chunk.key in self.resident or chunk.key not in self.target_set:
+            return
+        self.resident.add(chunk.key)
+        if chunk.key in self.tiles.modified:
+            # Edited before the chunk arrived, the edits win
+            chunk = merge_edits(chunk, self.tiles.chunks.get(chunk.key))
+        self.tiles.set_chunk(chunk)
+
+    def all_chunks(self):
+        # Every chunk of the world, whether it is resident or still on disk
+        for key in self.stored.union(self.tiles.chunks):
+            chunk = self.tiles.chunks.get(key)
+            if key in self.stored and key not in self.resident:
+                with self.reading:
+                    stored = self.read(key)
+                chunk = merge_edits(stored, chunk)
+            if chunk:
+                yield chunk
+
+    def save(self, filename, compress=True):
+        write_world(filename, self.all_chunks(), compress)
+        if filename == self.world.file.name:
+            # Everything in memory is on disk now and may be paged out again
+            with self.reading:
+                self.world.close()
+                self.edits = None
+                self.open(filename)
+            self.resident.update(self.tiles.chunks)
+            self.tiles.modified.clear()
+
+    def close(self):
+        with self.lock:
+            self.running = False
+            self.lock.notify()
+        self.worker.join()
+        self.world.close()
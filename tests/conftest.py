@@ -0,0 +1,32 @@
+import os
+import sys
+
+# The game's modules live at the top of the repository
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+
+import numpy as np
+import pytest
+from isotiles import IsoTiles
+from sprites import SpriteCatalogue
+
+
+@pytest.fixture
+def make_tiles():
+    # Builds square worlds of side x side cells around (0, 0). fill of the cells
+    # hold a tile, of a type in range(types), and flipped of the tiles are
+    # flipped. Without sprites the world can be edited but not drawn
+    def make(sprites=None, side=40, fill=1.0, types=1, flipped=0.0, seed=0):
+        rng = np.random.default_rng(seed)
+        i, j = np.meshgrid(np.arange(side), np.arange(side), indexing="ij")
+        coords = np.stack((i.ravel(), j.ravel()), axis=1) - side // 2
+        coords = coords[rng.random(len(coords)) < fill]
+        tiles = IsoTiles(sprites if sprites is not None else SpriteCatalogue())
+        tiles.add_tiles(
+            coords,
+            rng.integers(0, types, len(coords)),
+            rng.random(len(coords)) < flipped,
+        )
+        return tiles
+
+    return make
@@ -0,0 +1,31 @@
+import json
+import pygame as pg
+from inputs import ScriptedInput
+
+
+def script(tmp_path, records):
+    filename = tmp_path / "script.jsonl"
+    filename.write_text("".join(json.dumps(r) + "\n" for r in records))
+    return ScriptedInput(str(filename))
+
+
+def test_events_are_replayed_once(tmp_path):
+    pg.init()
+    inputs = script(
+        tmp_path,
+        [
+            {"tick": 2, "event": "KEYDOWN", "key": "m"},
+            {"tick": 3, "event": "MOUSEMOTION", "pos": [4, 5]},
+            {"tick": 5, "event": "KEYUP", "key": "m"},
+        ],
+    )
+    assert inputs.events(0) == []
+    # Frames without a simulation step poll the same tick again
+    assert [e.type for e in inputs.events(2)] == [pg.KEYDOWN]
+    assert inputs.events(2) == []
+    assert inputs.pressed()[pg.K_m]
+    # Frames with several steps skip ticks, their events still arrive in order
+    assert [e.type for e in inputs.events(6)] == [pg.MOUSEMOTION, pg.KEYUP]
+    assert inputs.mouse_pos() == (4, 5)
+    assert not inputs.pressed()[pg.K_m]
+    assert inputs.events(7) == []
@@ -0,0 +1,136 @@
+import os
+import time
+import numpy as np
+import pytest
+from chunks import CHUNK_SIZE, chunk_tiles
+from isotiles import IsoTiles
+from journal import MAGIC, RECORD, EditJournal, TileEdits, journal_files
+from sprites import SpriteCatalogue
+from streaming import ChunkStreamer
+
+
+def edit(tiles: IsoTiles, seed=1, count=500, spread=50):
+    # Every kind of edit, some of them on tiles that do not exist
+    rng = np.random.default_rng(seed)
+    for i, j in rng.integers(-spread, spread, (count, 2)).tolist():
+        match int(rng.integers(0, 4)):
+            case 0:
+                flipped = bool(rng.random() < 0.5)
+                tiles.add_tile((i, j), int(rng.integers(0, 4)), flipped)
+            case 1:
+                tiles.remove_tile((i, j))
+            case 2:
+                tiles.flip_tile((i, j))
+            case 3:
+                tiles.set_tile_type((i, j), int(rng.integers(0, 4)))
+    tiles.add_tiles(rng.integers(-spread, spread, (100, 2)), 2, True)
+    # Empty a whole chunk, so it has to disappear from the world
+    for i in range(CHUNK_SIZE):
+        for j in range(CHUNK_SIZE):
+            tiles.remove_tile((i, j))
+
+
+def content(chunks):
+    coords, types, flipped = chunk_tiles(chunks)
+    return coords.tolist(), types.tolist(), flipped.tolist()
+
+
+def reload(snapshot):
+    edits = TileEdits.read(*journal_files(snapshot))
+    return IsoTiles.from_binary(SpriteCatalogue(), snapshot, edits)
+
+
+@pytest.fixture
+def journaled(tmp_path, make_tiles):
+    # Tiles saved to a snapshot, with a journal for the edits made after that
+    snapshot = str(tmp_path / "world.isow")
+    tiles = make_tiles(side=80, fill=0.3, types=4, flipped=0.3)
+    tiles.to_binary(snapshot)
+    tiles.journal = EditJournal(snapshot, truncate=True)
+    yield tiles, snapshot
+    tiles.journal.close()
+
+
+def test_binary_round_trip(tmp_path, make_tiles):
+    tiles = make_tiles(side=80, fill=0.3, types=4, flipped=0.3)
+    for compress in (True, False):
+        filename = str(tmp_path / f"world{compress}.isow")
+        tiles.to_binary(filename, compress)
+        loaded = IsoTiles.from_binary(SpriteCatalogue(), filename)
+        assert content(loaded.chunks.values()) == content(tiles.chunks.values())
+
+
+def test_journal_replay(journaled):
+    tiles, snapshot = journaled
+    edit(tiles)
+    tiles.journal.flush()
+    assert len(TileEdits.read(*journal_files(snapshot))) == tiles.journal.count
+    assert content(reload(snapshot).chunks.values()) == content(tiles.chunks.values())
+
+
+def test_compaction(journaled):
+    tiles, snapshot = journaled
+    edit(tiles)
+    tiles.journal.compact()
+    # Edits made while compacting land in the fresh journal
+    edit(tiles, seed=2)
+    tiles.journal.compactor.join()
+    tiles.journal.flush()
+    old, current = journal_files(snapshot)
+    assert not os.path.exists(old)
+    assert len(TileEdits.read(current)) == tiles.journal.count
+    assert content(reload(snapshot).chunks.values()) == content(tiles.chunks.values())
+
+
+def test_torn_record(journaled):
+    tiles, snapshot = journaled
+    edit(tiles)
+    tiles.journal.close()
+    expected = content(tiles.chunks.values())
+    # A crash in the middle of writing the next record
+    with open(journal_files(snapshot)[1], "ab") as jfile:
+        jfile.write(RECORD.pack(1000, 1000, 1, 0)[:5])
+    replayed = content(reload(snapshot).chunks.values())
+    # Reopening drops the partial record before appending again
+    tiles.journal = EditJournal(snapshot)
+    assert replayed == expected
+    tiles.add_tile((1000, 1000), 3, False)
+    tiles.journal.flush()
+    size = os.path.getsize(journal_files(snapshot)[1])
+    assert (size - len(MAGIC)) % RECORD.size == 0
+    assert content(reload(snapshot).chunks.values()) == content(tiles.chunks.values())
+
+
+def test_streamed_replay(journaled):
+    tiles, snapshot = journaled
+    edit(tiles)
+    tiles.journal.flush()
+    streamed = IsoTiles(SpriteCatalogue())
+    edits = TileEdits.read(*journal_files(snapshot))
+    streamer = ChunkStreamer(streamed, snapshot, edits=edits)
+    try:
+        assert content(streamer.all_chunks()) == content(tiles.chunks.values())
+    finally:
+        streamer.close()
+
+
+def test_retarget_reads_each_chunk_once(journaled):
+    tiles, snapshot = journaled
+    streamed = IsoTiles(SpriteCatalogue())
+    streamer = ChunkStreamer(streamed, snapshot, budget=30, per_frame=0)
+    reads = []
+    read = streamer.read
+    streamer.read = lambda key: reads.append(key) or read(key)
+    try:
+        # Nothing is installed while the camera moves away and back, so the
+        # chunks read at first are still waiting when they are wanted again
+        for center in ((0, 0), (40, 0), (0, 0)):
+            streamer.update(center)
+            while streamer.loaded.qsize() < len(streamer.queued):
+                time.sleep(0.001)
+        streamer.per_frame = len(streamer.queued)
+        streamer.update((0, 0))
+        assert streamer.resident == streamer.target_set
+        assert len(reads) == len(set(reads))
+    finally:
+        streamer.close()
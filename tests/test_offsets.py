@@ -0,0 +1,67 @@
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import pytest
+from pygame.math import Vector2 as Vec2
+from effects import CircularWaveAnimation, CrossWaveAnimation, DirectedShockwave
+from isotiles import IsoTiles
+
+EFFECTS = (DirectedShockwave, CrossWaveAnimation, CircularWaveAnimation)
+
+
+@pytest.mark.parametrize("kind", EFFECTS)
+def test_batch_offsets_match_single_ones(kind):
+    rng = np.random.default_rng(1)
+    coords = rng.integers(-12, 12, (20_000, 2)).astype(float)
+    effect = kind(amplitude=1.5, ahead=0.8, trail=2, epicenter=(1, -2), dir=Vec2(1, 1))
+    for _ in range(4):
+        for _ in range(10):
+            effect.update(1 / 60)
+        single = [effect.get_offset((i, j)) for i, j in coords.tolist()]
+        batch = effect.get_offsets(coords)
+        assert np.count_nonzero(batch)
+        np.testing.assert_allclose(batch, single, atol=1e-12)
+
+
+def add_effects(tiles: IsoTiles, count, seed=0):
+    # A mix of all effect kinds over the world, some time into their run
+    rng = np.random.default_rng(seed)
+    for n, center in enumerate(rng.integers(-30, 30, (count, 2)).tolist()):
+        tiles.animations.add(
+            EFFECTS[n % len(EFFECTS)](
+                amplitude=1.5, ahead=0.8, trail=2, epicenter=center, dir=Vec2(1, 0)
+            )
+        )
+    for _ in range(30):
+        tiles.update(1 / 60)
+    return tiles
+
+
+def test_offset_field_matches_every_effect(make_tiles):
+    # Effects are only evaluated on the chunks they reach, that must not lose
+    # any of their offsets
+    tiles = add_effects(make_tiles(side=60), 30)
+    chunks = sorted(tiles.chunks.values(), key=lambda c: c.key)
+    field = np.concatenate(tiles.offset_field(chunks))
+    coords = np.concatenate([c.coord_array() for c in chunks])
+    expected = [
+        sum(a.get_offset((i, j)) for a in tiles.animations)
+        for i, j in coords.tolist()
+    ]
+    assert np.count_nonzero(field)
+    np.testing.assert_allclose(field, expected, atol=1e-12)
+    lookups = [tiles.get_tile_offset((i, j)) for i, j in coords.tolist()]
+    np.testing.assert_array_equal(field, lookups)
+    np.testing.assert_array_equal(field, tiles.get_tile_offsets(coords.astype(int)))
+
+
+@pytest.mark.parametrize("workers", (2, 3, 8))
+def test_strips_match_the_serial_field(make_tiles, workers):
+    tiles = add_effects(make_tiles(side=60), 60)
+    chunks = sorted(tiles.chunks.values(), key=lambda c: c.key)
+    serial = np.concatenate(tiles.offset_field(chunks))
+    # Small strips, so every worker gets some of the chunks
+    tiles.STRIP_TILES = 64
+    with ThreadPoolExecutor(workers) as pool:
+        tiles.use_pool(pool, workers)
+        parallel = np.concatenate(tiles.offset_field(chunks))
+    assert serial.tobytes() == parallel.tobytes()
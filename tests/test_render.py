@@ -0,0 +1,168 @@
+import os
+import numpy as np
+import pygame as pg
+import pytest
+from pygame.math import Vector2 as Vec2
+from effects import CircularWaveAnimation
+from isotiles import IsoTiles
+from sprites import Sprite, SpriteCatalogue
+
+DATA = os.path.join(os.path.dirname(os.path.dirname(__file__)), "data")
+
+
+@pytest.fixture(scope="module")
+def sprites():
+    pg.init()
+    catalogue = SpriteCatalogue()
+    catalogue.add_sprites(
+        *(Sprite.from_file(os.path.join(DATA, f"tile{n}.png")) for n in (1, 2))
+    )
+    return catalogue
+
+
+@pytest.fixture
+def world(sprites, make_tiles):
+    # Builds the same drawable world every time it is called
+    return lambda: make_tiles(sprites, types=2, flipped=0.3)
+
+
+def render(tiles: IsoTiles, origins, bake=True, cull=True):
+    # The last frame after drawing at each of the origins in turn
+    if not bake:
+        tiles.is_static_chunk = lambda chunk: False
+    if not cull:
+        everything = [tiles.chunks[k] for k in sorted(tiles.chunks)]
+        tiles.visible_chunks = lambda view: everything
+    surf = pg.Surface((800, 600))
+    for orig in origins:
+        surf.fill((0, 0, 0))
+        tiles.set_origin(Vec2(orig))
+        tiles.draw(surf)
+    return pg.image.tobytes(surf, "RGB")
+
+
+@pytest.mark.parametrize("alpha", (0.3, 0.5, 0.8))
+def test_baked_chunks_line_up_while_panning(world, alpha):
+    # Chunks baked at one camera position and drawn at a fractional one look
+    # exactly like chunks drawn tile by tile
+    origins = [(400, 300), (400 + 3 * alpha, 300 - 2 * alpha)]
+    tiles = world()
+    baked = render(tiles, origins)
+    assert tiles.baked
+    assert baked == render(world(), origins, bake=False)
+
+
+def test_visible_chunks_are_never_evicted(world, monkeypatch):
+    # With room for only some of the visible chunks, those stay baked and the
+    # rest is drawn tile by tile
+    bakes = []
+    bake_chunk = IsoTiles.bake_chunk
+
+    def counted(tiles, chunk, *args):
+        bakes.append(chunk.key)
+        bake_chunk(tiles, chunk, *args)
+
+    monkeypatch.setattr(IsoTiles, "bake_chunk", counted)
+    tiles = world()
+    tiles.BAKE_BUDGET = 12 * 1024 * 1024
+    image = render(tiles, [(400, 300)] * 3)
+    assert bakes and sorted(bakes) == sorted(tiles.baked)
+    assert tiles.baked_bytes <= tiles.BAKE_BUDGET
+    assert image == render(world(), [(400, 300)], bake=False)
+
+
+def test_oversized_chunks_are_not_baked(sprites, world):
+    sprites.scale_catalogue(2.0)
+    try:
+        tiles = world()
+        image = render(tiles, [(400, 300)] * 2)
+        assert not tiles.baked
+        assert image == render(world(), [(400, 300)], bake=False)
+    finally:
+        sprites.scale_catalogue(1.0)
+
+
+def test_atlases_of_previous_zoom_levels_are_kept():
+    catalogue = SpriteCatalogue()
+    catalogue.add_sprites(Sprite.from_file(os.path.join(DATA, "tile1.png")))
+    scales = [step / 10 for step in range(1, 21)]
+    atlases = []
+    for scale in scales:
+        catalogue.scale_catalogue(scale)
+        atlases.append(catalogue.atlas()[0])
+    for scale, atlas in zip(scales, atlases):
+        catalogue.scale_catalogue(scale)
+        assert catalogue.atlas()[0] is atlas
+
+def test_array_projection_matches_single_points(sprites):
+    tiles = IsoTiles(sprites)
+    tiles.set_origin(Vec2(413, 287))
+    rng = np.random.default_rng(2)
+    coords = rng.integers(-500, 500, (2000, 2))
+    offsets = rng.random(len(coords))
+    screen = tiles.iso_to_screen_array(coords, offsets)
+    single = [tiles.iso_to_screen(t, o) for t, o in zip(coords.tolist(), offsets)]
+    assert screen.tolist() == [[v.x, v.y] for v in single]
+    points = rng.uniform(-3000, 3000, (2000, 2))
+    back = tiles.screen_to_iso_array(points)
+    assert back.tolist() == [list(tiles.screen_to_iso(p)) for p in points.tolist()]
+
+
+def lift_tile(tiles: IsoTiles):
+    tiles.set_tile_offset((8, 9), -8)
+
+
+def stack_waves(tiles: IsoTiles):
+    for _ in range(6):
+        tiles.animations.add(
+            CircularWaveAnimation(
+                epicenter=(9, 9), speed=0, dampening=0, amplitude=1.5, trail=3, ahead=3
+            )
+        )
+    tiles.update()
+
+
+@pytest.mark.parametrize("lift", (lift_tile, stack_waves))
+def test_tiles_lifted_into_view_are_drawn(sprites, make_tiles, lift):
+    # The tiles start below the bottom of the view, their offsets lift them into it
+    frames = []
+    for cull in (True, False):
+        tiles = make_tiles(sprites, side=80)
+        lift(tiles)
+        frames.append(render(tiles, [(400, 0)], cull=cull))
+    assert frames[0] == frames[1]
+    assert frames[0] != render(make_tiles(sprites, side=80), [(400, 0)])
+
+
+def lower_tile(tiles: IsoTiles):
+    tiles.set_tile_offset((8, 9), 0)
+
+
+@pytest.mark.parametrize("steps", ((lift_tile,), (lift_tile, lower_tile)))
+def test_dirty_rects_cover_lifted_tiles(sprites, make_tiles, steps):
+    # Redrawing only the dirty rects after each step looks like a full redraw,
+    # both where the tile is drawn now and where it was drawn before
+    tiles = make_tiles(sprites, side=80)
+    tiles.track_dirty = True
+    tiles.set_origin(Vec2(400, -400))
+    view = pg.Rect(0, 0, 800, 600)
+    surf = pg.Surface(view.size)
+    tiles.draw(surf)
+    tiles.take_dirty_rects(view)
+    for step in steps:
+        step(tiles)
+        for rect in tiles.take_dirty_rects(view):
+            surf.set_clip(rect)
+            surf.fill((0, 0, 0))
+            tiles.draw(surf)
+        surf.set_clip(None)
+        full = pg.Surface(view.size)
+        tiles.draw(full)
+        assert pg.image.tobytes(surf, "RGB") == pg.image.tobytes(full, "RGB")
+
+
+def test_dirty_regions_are_only_recorded_when_tracked(make_tiles):
+    tiles = make_tiles()
+    lift_tile(tiles)
+    tiles.drop_chunk((0, 0))
+    assert not tiles.dirty and not tiles.dirty_tiles
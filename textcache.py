@@ -0,0 +1,36 @@
+import pygame as pg
+from sprites import SurfaceCache
+
+# Memory available to rendered text
+TEXT_CACHE_BYTES = 4 * 1024 * 1024
+
+
+class TextCache:
+    # Rendered blocks of text by (font, text, color, sep), the least recently
+    # used ones are dropped once they take more than budget bytes
+    def __init__(self, budget=TEXT_CACHE_BYTES):
+        self.surfaces = SurfaceCache(budget)
+
+    def block(self, font: pg.font.Font, text, color, sep) -> pg.Surface:
+        # All lines of text in one surface, each sep pixels below the previous one
+        color = tuple(color)
+        return self.surfaces.get(
+            (font, text, color, sep), lambda: render_block(font, text, color, sep)
+        )
+
+
+def render_block(font: pg.font.Font, text, color, sep) -> pg.Surface:
+    lines = [font.render(line, True, color) for line in text.splitlines()]
+    width = max((s.get_width() for s in lines), default=0)
+    height = sep * (len(lines) - 1) + lines[-1].get_height() if lines else 0
+    block = pg.Surface((max(width, 1), max(height, 1)), pg.SRCALPHA)
+    block.fill((0, 0, 0, 0))
+    # Copies the antialiased edges as they are, where lines overlap the stronger
+    # pixel wins
+    block.blits(
+        [(s, (0, n * sep), None, pg.BLEND_RGBA_MAX) for n, s in enumerate(lines)],
+        False,
+    )
+    if pg.display.get_surface() is not None:
+        block = block.convert_alpha()
+    return block
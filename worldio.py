@@ -0,0 +1,145 @@
+import os
+import sys
+import json
+import mmap
+import struct
+import zlib
+import numpy as np
+from chunks import CHUNK_SIZE, TileChunk, chunk_tiles, fill_chunks
+
+# Binary world file layout (little endian):
+#   header   magic, format version, chunk size, number of chunks
+#   table    one TABLE entry per chunk: chunk key, payload offset/length, codec
+#   payloads per chunk CHUNK_SIZE**2 int16 tile types followed by as many
+#            uint8 flags, row major, optionally zlib compressed
+MAGIC = b"ISOW"
+VERSION = 1
+HEADER = struct.Struct("<4sHHI")
+TABLE = np.dtype(
+    [("key", "<i4", (2,)), ("offset", "<u8"), ("length", "<u4"), ("codec", "<u4")]
+)
+CODEC_RAW = 0
+CODEC_ZLIB = 1
+
+
+def dumps_tiles(coords, types, flipped) -> str:
+    s = {
+        "tile_loc": coords.tolist(),
+        "tile_type": types.tolist(),
+        "flipped": coords[flipped].tolist(),
+    }
+    return json.dumps(s)
+
+
+def loads_tiles(json_str: str):
+    d = json.loads(json_str)
+    coords = np.array(d["tile_loc"], dtype=np.int64).reshape(-1, 2)
+    flipped = {(f[0], f[1]) for f in d["flipped"]}
+    return (
+        coords,
+        np.array(d["tile_type"], dtype=np.int16),
+        np.array([(i, j) in flipped for i, j in coords.tolist()], dtype=bool),
+    )
+
+
+def write_world(filename, chunks, compress=True):
+    chunks = sorted((c for c in chunks if c), key=lambda c: c.key)
+    table = np.zeros(len(chunks), TABLE)
+    offset = HEADER.size + TABLE.itemsize * len(chunks)
+    # Write to a temporary file first, so a failed save keeps the old world
+    tmpname = f"{filename}.tmp"
+    with open(tmpname, "wb") as f:
+        f.seek(offset)
+        for n, c in enumerate(chunks):
+            data = c.types.astype("<i2").tobytes() + c.flags.tobytes()
+            codec = CODEC_RAW
+            if compress and len(packed := zlib.compress(data)) < len(data):
+                data, codec = packed, CODEC_ZLIB
+            table[n] = (c.key, offset, len(data), codec)
+            f.write(data)
+            offset += len(data)
+        f.seek(0)
+        f.write(HEADER.pack(MAGIC, VERSION, CHUNK_SIZE, len(chunks)))
+        f.write(table.tobytes())
+    os.replace(tmpname, filename)
+
+
+class WorldFile:
+    # Read access to a binary world file. The file is memory mapped, so only the
+    # chunks that are actually read get paged in
+
+    def __init__(self, filename):
+        self.file = open(filename, "rb")
+        self.mm = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, chunk_size, count = HEADER.unpack_from(self.mm, 0)
+        if magic != MAGIC or version != VERSION:
+            self.close()
+            raise ValueError(f"{filename} is not a world file")
+        if chunk_size != CHUNK_SIZE:
+            self.close()
+            raise ValueError(
+                f"{filename} uses chunks of {chunk_size} tiles, expected {CHUNK_SIZE}"
+            )
+        self.table = np.frombuffer(self.mm, TABLE, count, HEADER.size).copy()
+        self.index = {
+            (k[0], k[1]): n for n, k in enumerate(self.table["key"].tolist())
+        }
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.mm.close()
+        self.file.close()
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, key):
+        return key in self.index
+
+    def keys(self):
+        return list(self.index)
+
+    def read_chunk(self, key) -> TileChunk:
+        entry = self.table[self.index[key]]
+        start = int(entry["offset"])
+        data = self.mm[start : start + int(entry["length"])]
+        if entry["codec"] == CODEC_ZLIB:
+            data = zlib.decompress(data)
+        cells = CHUNK_SIZE * CHUNK_SIZE
+        chunk = TileChunk(key)
+        chunk.types[:] = np.frombuffer(data, "<i2", cells).reshape(chunk.types.shape)
+        chunk.flags[:] = np.frombuffer(data, np.uint8, cells, 2 * cells).reshape(
+            chunk.flags.shape
+        )
+        chunk.recount()
+        return chunk
+
+
+def json_to_binary(src, dst, compress=True):
+    with open(src, "r") as sfile:
+        coords, types, flipped = loads_tiles(sfile.read())
+    chunks = {}
+    fill_chunks(chunks, coords, types, flipped)
+    write_world(dst, chunks.values(), compress)
+
+
+def binary_to_json(src, dst):
+    with WorldFile(src) as world:
+        chunks = [world.read_chunk(key) for key in world.keys()]
+    with open(dst, "w") as dfile:
+        dfile.write(dumps_tiles(*chunk_tiles(chunks)))
+
+
+if __name__ == "__main__":
+    # Convert between the two formats, e.g. python worldio.py world.json world.isow
+    if len(sys.argv) != 3:
+        sys.exit(f"usage: {sys.argv[0]} SRC DST")
+    if sys.argv[1].endswith(".json"):
+        json_to_binary(sys.argv[1], sys.argv[2])
+    else:
+        binary_to_json(sys.argv[1], sys.argv[2])